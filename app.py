@@ -7,18 +7,36 @@ from google.oauth2.service_account import Credentials
 # PDF 相關套件
 import requests
 import os
+import json
+import time
+import random
+import threading
+import uuid
+import sqlite3
+import numbers
+import functools
+import re
+import heapq
+import hashlib
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from io import BytesIO
+import tempfile
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 
 # Google Drive 相關套件
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
 
 # ==========================================
 # 1. 核心設定與初始化
@@ -29,44 +47,536 @@ st.set_page_config(page_title="辦公室飲料點餐系統", page_icon="🥤", l
 DEFAULT_MENUS = {"範例店家": {"紅茶": {"單一規格": 30}}}
 SUGAR_OPTS = ["正常糖", "少糖 (8分)", "半糖 (5分)", "微糖 (3分)", "一分糖", "無糖"]
 ICE_OPTS = ["正常冰", "少冰", "微冰", "去冰", "常溫", "熱"]
+ORDER_HEADERS = ['時間', '店家', '姓名', '品項', '大小', '加料', '價格', '甜度', '冰塊', '備註']
+ORDER_CATEGORY_COLS = ['店家', '品項', '大小', '甜度', '冰塊']   # 訂單 DataFrame 中以 category 儲存的欄位
+ORDER_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-# 初始化字型 (快取資源)
+# 多個訂單群組 (樓層 / 辦公室) 共用同一個程序：以網址參數 ?room=<id> 選擇，Secrets 的 [tenants.<id>] 各自設定
+TENANT_PARAM = "room"
+DEFAULT_TENANT = "default"      # 沒有 [tenants] 設定時的單一群組
+HTTP_POOL_SIZE = 20             # 共用 HTTP session 的 keep-alive 連線數上限
+
+# 訂單寫入佇列設定
+ORDER_SPOOL_PATH = "pending_orders.jsonl"  # 本機暫存檔 (尚未寫入 Sheet 的訂單)
+ORDER_FLUSH_INTERVAL = 0.3                 # 背景批次寫入間隔 (秒)
+ORDER_RETRY_BASE = 1.0                     # 退避起始秒數 (指數成長 + 隨機抖動)
+ORDER_RETRY_MAX = 30.0
+
+# 本機儲存後端設定
+SETTINGS_MAX_AGE = 15           # 菜單 / 加料 / 餘額快取的新鮮期 (秒)，過期後先回傳舊資料並在背景重新讀取
+MENU_SNAPSHOT_PATH = "menu_snapshot.json"  # 編譯後的菜單快照 (程序重啟後直接載入)
+MENU_SNAPSHOT_FORMAT = 1        # 快照格式版本，格式不符時重新編譯
+MENU_CHECK_INTERVAL = 60        # 查詢試算表修改時間的間隔 (秒)，修改時間改變才重新讀取並編譯菜單
+ORDER_POLL_INTERVAL = 5         # 訂單增量輪詢間隔 (秒)，所有 session 共用同一次輪詢
+ORDER_FULL_RELOAD = 60          # 定期整表重讀，反映直接在 Sheet 中段修改的內容 (秒)
+ORDER_LIST_REFRESH = 5          # 訂單列表整份重新繪製的間隔 (秒)，只讀記憶體中的共用狀態
+ORDER_LIVE_REFRESH = 0.5        # 新訂單提示檢查推播的間隔 (秒)，沒有新事件時不輸出任何元素
+ORDER_WATCH_IDLE = 30           # 超過此秒數沒有人檢視訂單列表時，背景輪詢暫停 (秒)
+
+SQLITE_PATH = "drinks.db"       # storage_backend = "sqlite" 時的資料庫檔案
+SHEET_SYNC_INTERVAL = 60        # 本機資料同步到 Google Sheet 鏡像的間隔 (秒)
+LOG_HEADERS = ["時間", "姓名", "變動金額", "變動後餘額", "備註"]
+
+# PDF 報表設定
+PDF_TABLE_CHUNK = 500                  # 明細逐段轉成字串的列數 (不必一次轉換整張 DataFrame)
+PDF_SPOOL_MAX = 4 * 1024 * 1024        # PDF 超過此大小改寫入磁碟暫存檔 (bytes)
+REPORT_WORKERS = 1                     # 背景產生 / 上傳報表的執行緒數
+REPORT_JOB_KEEP = 10                   # 保留最近幾筆報表工作 (含 PDF) 供下載
+REPORT_STATUS_REFRESH = 2              # 報表工作進行中時，狀態自動更新的間隔 (秒)
+
+# 結算日誌設定
+SETTLEMENT_JOURNAL_PATH = "settlements.json"  # 結算預寫日誌 (計畫與已完成步驟)
+SETTLEMENT_JOURNAL_KEEP = 30                  # 保留最近幾筆結算紀錄
+ORDER_ARCHIVE_PATH = "order_history.db"       # 已結算訂單的本機歷史資料庫 (只新增、不修改)
+ARCHIVE_QUERY_LIMIT = 500                     # 歷史分析每次查詢最多回傳的列數
+
+# 字型設定：PDF 產生時不再即時下載，啟動時於背景預熱並註冊一次
+FONT_NAME = "ChineseFont"
+FONT_CACHE_PATH = "chinese_font.ttf"   # 下載後的本機快取 (之後的容器啟動直接使用)
+FONT_BUNDLE_DIR = "fonts"              # 隨專案附帶的字型目錄 (放入 .ttf 即優先使用)
+FONT_CID_FALLBACK = "MSung-Light"      # 內建繁中 CID 字型：不需字型檔，找不到 TTF 時使用
+FONT_WAIT_TIMEOUT = 20                 # 產生 PDF 時最多等待背景預熱的秒數
+# 優先使用 Open Huninn (粉圓體)，備用 Google Noto Sans TC
+FONT_URLS = [
+    "https://raw.githubusercontent.com/justfont/open-huninn-font/master/font/jf-openhuninn-1.1.ttf",
+    "https://github.com/google/fonts/raw/main/ofl/notosanstc/static/NotoSansTC-Regular.ttf"
+]
+FONT_SYSTEM_DIRS = ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts"),
+                    "/Library/Fonts", "/System/Library/Fonts", "C:/Windows/Fonts"]
+FONT_SYSTEM_HINTS = ("huninn", "notosanstc", "notosanscjk", "notoserifcjk", "sourcehansans", "wqy",
+                     "msjh", "mingliu", "droidsansfallback", "arphic", "ukai", "uming")
+
+class FontProvider:
+    """中文字型來源：指定路徑 → 專案附帶 → 下載快取 → 系統字型 → (可選) 下載 → 內建 CID 字型。
+
+    解析過的 TTFont 只在行程內註冊一次；reportlab 嵌入 TTF 時本來就只寫入報表實際用到的字形
+    (subset)，所以上傳到 Drive 的 PDF 不會帶著整套數 MB 的字型檔。
+    """
+
+    def __init__(self, font_path=None, allow_download=True):
+        self.font_path = font_path
+        self.allow_download = allow_download
+        self.name = None
+        self.source = None
+        self.error = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def candidates(self):
+        """依優先順序列出本機可用的字型檔 (不含下載)。"""
+        paths = [self.font_path, os.environ.get("CJK_FONT_PATH")]
+        if os.path.isdir(FONT_BUNDLE_DIR):
+            paths += [os.path.join(FONT_BUNDLE_DIR, f) for f in sorted(os.listdir(FONT_BUNDLE_DIR))
+                      if f.lower().endswith((".ttf", ".ttc"))]
+        paths.append(FONT_CACHE_PATH)
+        for d in FONT_SYSTEM_DIRS:
+            if not os.path.isdir(d): continue
+            for root, _, files in os.walk(d):
+                for f in sorted(files):
+                    low = f.lower().replace("-", "").replace("_", "")
+                    if low.endswith((".ttf", ".ttc")) and any(h in low for h in FONT_SYSTEM_HINTS):
+                        paths.append(os.path.join(root, f))
+        seen = set()
+        return [p for p in paths if p and os.path.isfile(p) and not (p in seen or seen.add(p))]
+
+    def _register_ttf(self, path):
+        try:
+            pdfmetrics.registerFont(TTFont(FONT_NAME, path))
+        except Exception:
+            # CFF 外框 (.otf / Noto CJK .ttc) 或損毀的檔案：快取檔刪除以便下次重試，其他略過
+            if path == FONT_CACHE_PATH and os.path.exists(path): os.remove(path)
+            return False
+        self.name, self.source = FONT_NAME, path
+        return True
+
+    def _download(self):
+        tmp = FONT_CACHE_PATH + ".tmp"
+        for url in FONT_URLS:
+            try:
+                response = requests.get(url, timeout=15)
+                # 檢查內容是否為有效的二進位檔
+                if response.status_code == 200 and len(response.content) > 1000 and not response.content.startswith(b"<"):
+                    with open(tmp, "wb") as f:
+                        f.write(response.content)
+                    os.replace(tmp, FONT_CACHE_PATH)
+                    return True
+            except Exception:
+                continue
+        return False
+
+    @staticmethod
+    def _cid_font():
+        """註冊內建 CID 字型 (重複註冊無妨)，回傳字型名稱；失敗回傳錯誤訊息。"""
+        from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+        try:
+            pdfmetrics.registerFont(UnicodeCIDFont(FONT_CID_FALLBACK))
+            return FONT_CID_FALLBACK, None
+        except Exception as e:
+            return None, str(e)
+
+    def _register_cid(self):
+        name, error = self._cid_font()
+        if name: self.name, self.source = name, "cid"
+        else: self.error = error
+
+    def warm(self):
+        """解析並註冊字型 (同步執行；一般由 start() 在背景呼叫)。"""
+        try:
+            if any(self._register_ttf(p) for p in self.candidates()): return
+            if self.allow_download and self._download() and self._register_ttf(FONT_CACHE_PATH): return
+            self.error = "找不到可用的中文 TrueType 字型"
+            self._register_cid()
+        finally:
+            self._ready.set()
+
+    def start(self):
+        """啟動時呼叫：在背景預熱，不擋住第一位使用者的畫面。"""
+        with self._lock:
+            if self._started: return self
+            self._started = True
+        threading.Thread(target=self.warm, name="font-warmup", daemon=True).start()
+        return self
+
+    def font_name(self, timeout=FONT_WAIT_TIMEOUT):
+        """取得已註冊的字型名稱；預熱尚未完成時最多等待 timeout 秒，仍未完成則用內建 CID 字型。"""
+        self.start()
+        if not self._ready.wait(timeout):
+            # 預熱仍在進行：這次改用 CID 字型，但不改變狀態，預熱完成後照常使用註冊好的 TTF
+            return self._cid_font()[0] or 'Helvetica'
+        return self.name or 'Helvetica'
+
+    @property
+    def is_fallback(self):
+        return self.source in (None, "cid")
+
+# 初始化字型 (快取資源)：每個行程只解析一次字型檔
 @st.cache_resource
-def setup_chinese_font():
-    font_path = "chinese_font.ttf"
-    # 優先使用 Open Huninn (粉圓體)，備用 Google Noto Sans TC
-    urls = [
-        "https://raw.githubusercontent.com/justfont/open-huninn-font/master/font/jf-openhuninn-1.1.ttf",
-        "https://github.com/google/fonts/raw/main/ofl/notosanstc/static/NotoSansTC-Regular.ttf"
-    ]
-    
-    # 檢查並下載字型
-    if not os.path.exists(font_path):
-        with st.spinner("正在初始化系統字型 (第一次需約 10 秒)..."):
-            downloaded = False
-            for url in urls:
-                try:
-                    response = requests.get(url, timeout=15)
-                    # 檢查內容是否為有效的二進位檔
-                    if response.status_code == 200 and len(response.content) > 1000 and not response.content.startswith(b"<"):
-                        with open(font_path, "wb") as f:
-                            f.write(response.content)
-                        downloaded = True
-                        break
-                except:
-                    continue
-            
-            if not downloaded:
-                st.error("⚠️ 無法下載中文字型，PDF 報表可能會顯示亂碼。")
-                return None
+def get_font_provider(font_path=None, allow_download=True):
+    return FontProvider(font_path, allow_download).start()
 
-    try:
-        pdfmetrics.registerFont(TTFont('ChineseFont', font_path))
-        return 'ChineseFont'
-    except Exception:
-        # 如果註冊失敗，刪除檔案以便下次重試
-        if os.path.exists(font_path): os.remove(font_path)
-        return None
+# API 監控設定
+METRICS_LOG_PATH = "api_metrics.jsonl"       # 每次 API 呼叫一行 JSON (可供外部收集)
+METRICS_SNAPSHOT_PATH = "api_metrics.json"   # 各操作的累計統計，定期整檔覆寫
+METRICS_FLUSH_INTERVAL = 10                  # 寫出監控檔的間隔 (秒)
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024      # 呼叫紀錄超過此大小時輪替為 .1
+METRICS_SAMPLES = 500                        # 每個操作保留的延遲樣本數 (計算 p50 / p95)
+METRICS_RECENT = 30                          # 面板顯示的最近 rerun / 錯誤筆數
+
+# API 錯誤分類：quota / auth / not_found / server / network / other
+def classify_api_error(e):
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)  # gspread APIError / Drive HttpError
+    if code is None and getattr(e, "response", None) is not None:
+        code = getattr(e.response, "status_code", None)
+    msg = str(e)
+    if code == 429 or "Quota exceeded" in msg or "RATE_LIMIT_EXCEEDED" in msg or "rateLimitExceeded" in msg \
+            or "storageQuotaExceeded" in msg:
+        return "quota"
+    if code in (401, 403) or "PERMISSION_DENIED" in msg or "UNAUTHENTICATED" in msg or type(e).__name__ == "RefreshError":
+        return "auth"
+    if code == 404 or isinstance(e, (gspread.WorksheetNotFound, gspread.SpreadsheetNotFound)) or "File not found" in msg:
+        return "not_found"
+    if isinstance(code, int) and code >= 500:
+        return "server"
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, TimeoutError, ConnectionError)):
+        return "network"
+    return "other"
+
+# 由 HTTP 請求的網址推出操作名稱，例如 "POST values/{range}:append"
+def api_op_name(method, url):
+    path = urlparse(str(url)).path
+    m = re.search(r"/spreadsheets/[^/:]+(.*)$", path)
+    if m:
+        rest = re.sub(r"/values/[^:/]+", "/values/{range}", m.group(1)).lstrip("/")
+        return f"{method.upper()} {rest or 'metadata'}"
+    m = re.search(r"/drive/v3/(.*)$", path)
+    if m:
+        return f"{method.upper()} {re.sub(r'files/[^/]+', 'files/{id}', m.group(1))}"
+    return f"{method.upper()} {path}"
+
+class ApiMetrics:
+    """
+    記錄每次 Sheets / Drive 呼叫的耗時、次數與錯誤分類；每個 Streamlit rerun 另外彙總該次觸發的呼叫。
+    背景執行緒 (寫入佇列、快取更新、報表) 的呼叫歸在 "background"。
+    """
+
+    def __init__(self, log_path=METRICS_LOG_PATH, snapshot_path=METRICS_SNAPSHOT_PATH):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.started = time.time()
+        self._ops = {}
+        self._reruns = deque(maxlen=METRICS_RECENT)
+        self._errors = deque(maxlen=METRICS_RECENT)
+        self._buffer = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if log_path or snapshot_path:
+            threading.Thread(target=self._run, name="metrics-writer", daemon=True).start()
+
+    # --- 記錄 ---
+    def record(self, service, op, seconds, error=None):
+        kind = classify_api_error(error) if error is not None else None
+        rerun = getattr(self._local, "rerun", None)
+        now = time.time()
+        with self._lock:
+            s = self._ops.setdefault((service, op), {"count": 0, "errors": {}, "total": 0.0, "max": 0.0,
+                                                      "samples": deque(maxlen=METRICS_SAMPLES)})
+            s["count"] += 1
+            s["total"] += seconds
+            s["max"] = max(s["max"], seconds)
+            s["samples"].append(seconds)
+            if kind:
+                s["errors"][kind] = s["errors"].get(kind, 0) + 1
+                self._errors.append({"time": datetime.fromtimestamp(now).strftime("%H:%M:%S"), "service": service,
+                                     "op": op, "kind": kind, "error": str(error)[:200]})
+            if rerun is not None:
+                rerun["calls"] += 1
+                rerun["api_ms"] += seconds * 1000
+                if kind: rerun["errors"] += 1
+            if self.log_path:
+                self._buffer.append({"ts": round(now, 3), "service": service, "op": op, "ms": round(seconds * 1000, 1),
+                                     "error": kind, "rerun": rerun["id"] if rerun else "background"})
+
+    def traced(self, service, op, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(service, op, time.perf_counter() - t0, e)
+            raise
+        self.record(service, op, time.perf_counter() - t0)
+        return result
+
+    # --- rerun 追蹤 (同一個 script 執行緒) ---
+    def begin_rerun(self, scope="全頁", quiet=False):
+        """每次 rerun 開頭呼叫；上一次若因 st.rerun / st.stop 沒有走到 end_rerun，在此一併結束。
+        quiet 的 rerun 沒有呼叫任何 API 時不記錄 (高頻率的即時更新)。"""
+        self.end_rerun()
+        self._local.rerun = {"id": uuid.uuid4().hex[:6], "scope": scope, "start": time.time(),
+                             "calls": 0, "api_ms": 0.0, "errors": 0, "quiet": quiet}
+
+    def end_rerun(self):
+        rerun = getattr(self._local, "rerun", None)
+        if rerun is None: return
+        self._local.rerun = None
+        if rerun["quiet"] and not rerun["calls"]: return
+        rerun["wall_ms"] = (time.time() - rerun["start"]) * 1000
+        with self._lock:
+            self._reruns.append(rerun)
+
+    @contextmanager
+    def fragment_rerun(self, scope, quiet=False):
+        """Fragment 單獨重跑時另計一次 rerun；整頁 rerun 中順帶執行的 fragment 併入整頁統計。"""
+        if getattr(self._local, "rerun", None) is not None:
+            yield
+            return
+        self.begin_rerun(scope, quiet)
+        try:
+            yield
+        finally:
+            self.end_rerun()
+
+    # --- 查詢 ---
+    def stats(self):
+        with self._lock:
+            items = [(k, dict(v, samples=sorted(v["samples"]))) for k, v in self._ops.items()]
+        out = []
+        for (service, op), s in sorted(items, key=lambda kv: -kv[1]["total"]):
+            smp = s["samples"]
+            pct = lambda p: smp[min(len(smp) - 1, int(p * len(smp)))] * 1000 if smp else 0.0
+            out.append({"服務": service, "操作": op, "次數": s["count"], "錯誤": sum(s["errors"].values()),
+                        "錯誤分類": ", ".join(f"{k}:{n}" for k, n in sorted(s["errors"].items())),
+                        "平均 ms": round(s["total"] / s["count"] * 1000, 1), "p50 ms": round(pct(0.5), 1),
+                        "p95 ms": round(pct(0.95), 1), "最大 ms": round(s["max"] * 1000, 1),
+                        "累計秒數": round(s["total"], 2)})
+        return out
+
+    def reruns(self):
+        with self._lock:
+            return [{"rerun": r["id"], "範圍": r.get("scope", "全頁"), "時間": datetime.fromtimestamp(r["start"]).strftime("%H:%M:%S"),
+                     "API 次數": r["calls"], "API ms": round(r["api_ms"], 1), "錯誤": r["errors"],
+                     "總耗時 ms": round(r["wall_ms"], 1)} for r in reversed(self._reruns)]
+
+    def errors(self):
+        with self._lock:
+            return list(reversed(self._errors))
+
+    # --- 寫出監控檔 ---
+    def flush(self):
+        with self._lock:
+            buf, self._buffer = self._buffer, []
+        if self.log_path and buf:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > METRICS_LOG_MAX_BYTES:
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in buf)
+        if self.snapshot_path:
+            snap = {"updated": time.time(), "started": self.started, "ops": self.stats()}
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snap, f, ensure_ascii=False)
+            os.replace(tmp, self.snapshot_path)
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics Flush Error: {e}")
+
+@st.cache_resource
+def get_api_metrics():
+    return ApiMetrics()
+
+# API 配額設定 (Google Sheets 預設配額：每個服務帳號每分鐘 60 次讀取、60 次寫入；可在 Secrets 調整)
+API_READ_PER_MIN = 60
+API_WRITE_PER_MIN = 60
+API_DRIVE_PER_MIN = 600
+API_MAX_RETRIES = 5             # 單一請求遇到 429 的最多重試次數
+API_RETRY_BASE = 1.0            # 退避起始秒數 (指數成長 + 隨機抖動)
+API_RETRY_MAX = 32.0
+API_THROTTLE_RECOVERY = 60      # 遇到 429 降速後，回復到原速率所需秒數
+
+# 請求優先權 (數字越小越優先)：使用者送出訂單 > 一般讀取 > 管理員操作
+PRIORITY_ORDER, PRIORITY_READ, PRIORITY_ADMIN = 0, 1, 2
+PRIORITY_RESERVE = {PRIORITY_ORDER: 0.0, PRIORITY_READ: 0.05, PRIORITY_ADMIN: 0.15}  # 低優先權不能動用的額度比例
+PRIORITY_TIMEOUT = {PRIORITY_ORDER: 120, PRIORITY_READ: 20, PRIORITY_ADMIN: 60}    # 等待額度的上限 (秒)
+
+# 指數退避的等待秒數 (±20% 隨機抖動，避免多個 session 同時重試)
+def backoff_delay(attempt, base=API_RETRY_BASE, cap=API_RETRY_MAX):
+    return min(base * (2 ** attempt), cap) * random.uniform(0.8, 1.2)
+
+class RateLimitTimeout(Exception):
+    """等待 API 額度逾時 (訊息含 RATE_LIMIT_EXCEEDED，會被視為配額錯誤)。"""
+
+class TokenBucket:
+    def __init__(self, per_min):
+        self.capacity = float(per_min)
+        self.rate = per_min / 60.0
+        self.tokens = self.capacity
+        self.scale = 1.0                 # 遇到 429 時降低速率，之後逐步回復
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        dt = now - self.updated
+        self.updated = now
+        self.scale = min(1.0, self.scale + dt / API_THROTTLE_RECOVERY)
+        self.tokens = min(self.capacity, self.tokens + dt * self.rate * self.scale)
+
+class RateLimiter:
+    """
+    全程序共用的 Token bucket (讀取 / 寫入 / Drive 各一個)，所有 session 與背景執行緒的請求都從這裡取額度。
+    額度不足時依優先權排隊；低優先權另外不能動用最後一部分額度，讓使用者的請求不必排在管理員後面。
+    """
+
+    def __init__(self, read_per_min=API_READ_PER_MIN, write_per_min=API_WRITE_PER_MIN, drive_per_min=API_DRIVE_PER_MIN):
+        self.buckets = {"read": TokenBucket(read_per_min), "write": TokenBucket(write_per_min),
+                        "drive": TokenBucket(drive_per_min)}
+        self._waiting = {k: [] for k in self.buckets}
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._local = threading.local()
+        self.stats = {k: {"acquired": 0, "waited": 0.0, "timeouts": 0, "throttled": 0} for k in self.buckets}
+
+    # --- 優先權 (每個執行緒各自設定) ---
+    def set_priority(self, priority):
+        self._local.priority = priority
+
+    def current_priority(self):
+        return getattr(self._local, "priority", PRIORITY_READ)
+
+    @contextmanager
+    def priority(self, priority):
+        prev = getattr(self._local, "priority", None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = prev if prev is not None else PRIORITY_READ
+
+    # --- 取得額度 ---
+    def acquire(self, bucket, priority=None):
+        """取得一次請求的額度，回傳等待秒數；超過該優先權的等待上限時拋出 RateLimitTimeout。"""
+        priority = self.current_priority() if priority is None else priority
+        b, queue = self.buckets[bucket], self._waiting[bucket]
+        t0 = time.monotonic()
+        deadline = t0 + PRIORITY_TIMEOUT.get(priority, 30)
+        with self._cond:
+            self._seq += 1
+            entry = (priority, self._seq)
+            heapq.heappush(queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    b.refill(now)
+                    reserve = PRIORITY_RESERVE.get(priority, 0.0) * b.capacity
+                    if queue[0] == entry and b.tokens - 1 >= reserve:
+                        b.tokens -= 1
+                        s = self.stats[bucket]
+                        s["acquired"] += 1
+                        s["waited"] += now - t0
+                        return now - t0
+                    if now >= deadline:
+                        self.stats[bucket]["timeouts"] += 1
+                        raise RateLimitTimeout(f"RATE_LIMIT_EXCEEDED: 等待 {bucket} 額度超過 {deadline - t0:.0f} 秒")
+                    if queue[0] == entry:
+                        wait = (reserve + 1 - b.tokens) / max(b.rate * b.scale, 1e-6)
+                    else:
+                        wait = 1.0  # 前面的人取得額度時會 notify
+                    self._cond.wait(max(0.01, min(wait, deadline - now)))
+            finally:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                self._cond.notify_all()
+
+    def throttled(self, bucket):
+        """收到 429：清空額度並把速率減半，之後在 API_THROTTLE_RECOVERY 秒內逐步回復。"""
+        with self._cond:
+            b = self.buckets[bucket]
+            b.refill(time.monotonic())
+            b.tokens = 0.0
+            b.scale = max(0.25, b.scale * 0.5)
+            self.stats[bucket]["throttled"] += 1
+
+    def snapshot(self):
+        with self._cond:
+            now = time.monotonic()
+            out = []
+            for k, b in self.buckets.items():
+                b.refill(now)
+                s = self.stats[k]
+                out.append({"額度": k, "剩餘": round(b.tokens, 1), "上限 / 分": int(b.capacity),
+                            "目前速率": f"{b.scale:.0%}", "排隊中": len(self._waiting[k]), "已取得": s["acquired"],
+                            "平均等待 ms": round(s["waited"] / s["acquired"] * 1000, 1) if s["acquired"] else 0.0,
+                            "逾時": s["timeouts"], "429 次數": s["throttled"]})
+            return out
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter(int(st.secrets.get("sheets_read_per_min", API_READ_PER_MIN)),
+                       int(st.secrets.get("sheets_write_per_min", API_WRITE_PER_MIN)),
+                       int(st.secrets.get("drive_per_min", API_DRIVE_PER_MIN)))
+
+# 依 HTTP 方法與網址判斷請求使用哪一個額度
+def api_bucket(method, url):
+    if "/drive/" in str(url): return "drive"
+    if method.upper() == "GET" or ":batchGet" in str(url) or "getByDataFilter" in str(url): return "read"
+    return "write"
+
+# 限速 + 重試：先取得額度再送出；429 時降速並以指數退避重試。
+# 寫入只在 429 (請求被拒絕、確定沒有寫入) 時重試；讀取另外也重試 5xx。
+def send_with_quota(limiter, bucket, send, is_throttled, is_retryable):
+    for attempt in range(API_MAX_RETRIES + 1):
+        limiter.acquire(bucket)
+        try:
+            return send()
+        except Exception as e:
+            throttled = is_throttled(e)
+            if throttled: limiter.throttled(bucket)
+            if attempt == API_MAX_RETRIES or not (throttled or is_retryable(e)): raise
+        time.sleep(backoff_delay(attempt))
+
+# 在 HTTP 層包住 gspread 的所有請求 (open_by_url、get_all_values、append_rows、batch_update…)：
+# 先向限速器取得額度，再計時送出；429 時降速重試
+def instrument_gspread(client, metrics, limiter=None):
+    http = client.http_client
+    if getattr(http, "_metrics", None) is metrics: return client
+    raw = http.request
+    def request(method, endpoint, *args, **kwargs):
+        op = api_op_name(method, endpoint)
+        send = lambda: metrics.traced("sheets", op, raw, method, endpoint, *args, **kwargs)
+        if limiter is None: return send()
+        bucket = api_bucket(method, endpoint)
+        return send_with_quota(limiter, bucket, send,
+                               is_throttled=lambda e: classify_api_error(e) == "quota",
+                               is_retryable=lambda e: bucket == "read" and classify_api_error(e) in ("server", "network"))
+    http.request, http._metrics = request, metrics
+    return client
+
+# Drive discovery client 的所有請求 (含 resumable upload 的每個分段) 都經過 service._http.request；
+# 這一層不會拋出 HTTP 錯誤，因此依回應狀態碼自行判斷
+def instrument_drive(service, metrics, limiter=None):
+    http = service._http
+    raw = http.request
+    def send(uri, method, args, kwargs):
+        op, t0 = api_op_name(method, uri), time.perf_counter()
+        try:
+            resp, content = raw(uri, method, *args, **kwargs)
+        except Exception as e:
+            metrics.record("drive", op, time.perf_counter() - t0, e)
+            raise
+        err = HttpError(resp, content, uri=uri) if resp.status >= 400 else None
+        metrics.record("drive", op, time.perf_counter() - t0, err)
+        # 速率限制 (429 / rateLimitExceeded) 轉成例外交給重試；storageQuotaExceeded 等其他錯誤照常回傳
+        if resp.status == 429 or (resp.status == 403 and b"ateLimitExceeded" in (content or b"")): raise err
+        return resp, content
+    def request(uri, method="GET", *args, **kwargs):
+        if limiter is None: return send(uri, method, args, kwargs)
+        return send_with_quota(limiter, "drive", lambda: send(uri, method, args, kwargs),
+                               is_throttled=lambda e: isinstance(e, HttpError), is_retryable=lambda e: False)
+    http.request = request
+    return service
 
 # 初始化 Google Sheet 連線 (快取資源)
 @st.cache_resource
@@ -89,185 +599,1711 @@ def get_google_client():
         if "\\n" in private_key:
             private_key = private_key.replace("\\n", "\n")
 
-        # 建立憑證
-        creds_dict = {
-            "type": s_info["type"],
-            "project_id": s_info["project_id"],
-            "private_key_id": s_info["private_key_id"],
-            "private_key": private_key,
-            "client_email": s_info["client_email"],
-            "client_id": s_info["client_id"],
-            "auth_uri": s_info.get("auth_uri", "https://accounts.google.com/o/oauth2/auth"),
-            "token_uri": s_info.get("token_uri", "https://oauth2.googleapis.com/token"),
-            "auth_provider_x509_cert_url": s_info.get("auth_provider_x509_cert_url", "https://www.googleapis.com/oauth2/v1/certs"),
-            "client_x509_cert_url": s_info["client_x509_cert_url"]
-        }
-        
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        client = gspread.authorize(creds)
-        return client, s_info
-    except Exception as e:
-        st.error(f"連線設定錯誤: {e}")
-        st.stop()
+        # 建立憑證
+        creds_dict = {
+            "type": s_info["type"],
+            "project_id": s_info["project_id"],
+            "private_key_id": s_info["private_key_id"],
+            "private_key": private_key,
+            "client_email": s_info["client_email"],
+            "client_id": s_info["client_id"],
+            "auth_uri": s_info.get("auth_uri", "https://accounts.google.com/o/oauth2/auth"),
+            "token_uri": s_info.get("token_uri", "https://oauth2.googleapis.com/token"),
+            "auth_provider_x509_cert_url": s_info.get("auth_provider_x509_cert_url", "https://www.googleapis.com/oauth2/v1/certs"),
+            "client_x509_cert_url": s_info["client_x509_cert_url"]
+        }
+        
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+        gc = gspread.authorize(creds)
+        # 所有群組、所有 session 共用這個 session 的連線池 (keep-alive) 與同一組 access token
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        gc.http_client.session.mount("https://", adapter)
+        client = instrument_gspread(gc, get_api_metrics(), get_rate_limiter())
+        return client, s_info
+    except Exception as e:
+        st.error(f"連線設定錯誤: {e}")
+        st.stop()
+
+# 訂單群組：每個群組有自己的試算表、Drive 資料夾與本機檔案，憑證 / 連線 / 限速 / 字型全程序共用
+class Tenant(NamedTuple):
+    id: str
+    name: str
+    spreadsheet: str
+    folder_id: object
+    storage_backend: str
+    sqlite_path: str
+
+    def path(self, base):
+        """群組專屬的本機檔案路徑：預設群組沿用原檔名，其他群組為 <檔名>.<id><副檔名>。"""
+        if self.id == DEFAULT_TENANT: return base
+        root, ext = os.path.splitext(base)
+        return f"{root}.{self.id}{ext}"
+
+def load_tenants(secrets, s_info):
+    """
+    回傳 {id: Tenant}。Secrets 有 [tenants.<id>] 區塊時每個區塊為一個群組 (name / spreadsheet /
+    drive_folder_id，可另設 storage_backend / sqlite_path)；沒有時沿用單一的 spreadsheet 設定。
+    id 只接受英數、底線與連字號 (會用在網址與檔名中)，不符或缺少 spreadsheet 的區塊略過。
+    """
+    kind = secrets.get("storage_backend", "sheets")
+    sqlite_path = secrets.get("sqlite_path", SQLITE_PATH)
+    if "tenants" not in secrets:
+        url = s_info.get("spreadsheet")
+        if not url: return {}
+        return {DEFAULT_TENANT: Tenant(DEFAULT_TENANT, "", url, get_folder_id(s_info), kind, sqlite_path)}
+    tenants = {}
+    for tid, conf in secrets["tenants"].items():
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", tid) or not conf.get("spreadsheet"): continue
+        t = Tenant(tid, conf.get("name", tid), conf["spreadsheet"], conf.get("drive_folder_id"),
+                   conf.get("storage_backend", kind), "")
+        tenants[tid] = t._replace(sqlite_path=conf.get("sqlite_path", t.path(sqlite_path)))
+    return tenants
+
+# ==========================================
+# 2. 資料讀取層 (Data Access Layer)
+# ==========================================
+
+# 會員儲值表的欄位候選名稱
+BALANCE_NAME_KEYS = ["姓名", "Name", "員工", "員工姓名"]
+BALANCE_VALUE_KEYS = ["存款餘額", "餘額", "存款", "Balance", "金額", "目前餘額"]
+
+# --- 2-1. 表格解析 (與儲存後端無關，輸入為 get_all_values() 格式的二維陣列) ---
+
+# 菜單的欄位候選名稱：(標題候選, 對應的大小)
+MENU_STORE_KEYS = ["店家", "Store"]
+MENU_ITEM_KEYS = ["品項", "Item", "飲料"]
+MENU_PRICE_KEYS = [(["中杯", "M", "m", "中"], "中杯"), (["大杯", "L", "l", "大"], "大杯"),
+                   (["價格", "Price", "單一規格"], "單一規格")]
+
+def find_col(headers, candidates):
+    for c in candidates:
+        if c in headers: return headers.index(c)
+    return -1
+
+# 解析價格儲存格："$1,200"、"NT$35"、"35元" 皆可；小數四捨五入為整數
+def parse_price(val):
+    """回傳 int；空白回傳 None；無法解析或為負數時拋出 ValueError。"""
+    v = str(val).replace(",", "").replace(" ", "").strip()
+    v = re.sub(r"^(NT\$|\$)|元$", "", v, flags=re.IGNORECASE)
+    if not v: return None
+    try:
+        d = Decimal(v)
+    except InvalidOperation:
+        raise ValueError(f"無法解析的價格「{val}」")
+    if not d.is_finite() or d < 0: raise ValueError(f"不合理的價格「{val}」")
+    return int(d.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+# 編譯菜單：驗證「菜單設定」表格，產生菜單與被略過的列
+def compile_menu(rows):
+    """
+    回傳 {"menus", "error", "rejected", "warnings", "rows", "hash"}：
+    rejected / warnings 為 [{"列": Sheet 列號, "店家", "品項", "原因"}]，有任何價格無法解析的列整列略過；
+    hash 為 menus (保留原順序) 的 SHA-256，內容相同時不變。
+    """
+    out = {"menus": None, "error": None, "rejected": [], "warnings": [], "rows": max(len(rows) - 1, 0), "hash": None}
+    if len(rows) < 2:
+        out["error"] = "無資料"
+        return out
+    
+    headers = [h.strip() for h in rows[0]]
+    idx_store = find_col(headers, MENU_STORE_KEYS)
+    idx_item = find_col(headers, MENU_ITEM_KEYS)
+    price_cols = [(find_col(headers, keys), size) for keys, size in MENU_PRICE_KEYS]
+    price_cols = [(i, size) for i, size in price_cols if i != -1]
+    if idx_store == -1 or idx_item == -1:
+        out["error"] = "欄位對應失敗"
+        return out
+
+    menus, seen = {}, {}
+    for n, row in enumerate(rows[1:], start=2):
+        if not any(str(c).strip() for c in row): continue
+        cell = lambda i: str(row[i]).strip() if i < len(row) else ""
+        store, item = cell(idx_store), cell(idx_item)
+        entry = {"列": n, "店家": store, "品項": item}
+        if not store or not item:
+            out["rejected"].append({**entry, "原因": "缺少店家或品項"})
+            continue
+        
+        prices, errors = {}, []
+        for i, size in price_cols:
+            try:
+                p = parse_price(cell(i))
+            except ValueError as e:
+                errors.append(f"{headers[i]}：{e}")
+                continue
+            if p is None: continue
+            prices[size] = p
+            raw = re.sub(r"[^\d.]", "", cell(i))
+            if "." in raw and Decimal(raw) != p:
+                out["warnings"].append({**entry, "原因": f"{headers[i]} 價格「{cell(i)}」四捨五入為 {p}"})
+        if errors:
+            out["rejected"].append({**entry, "原因": "；".join(errors)})
+            continue
+        # 有中杯 / 大杯 (大於 0) 時只使用這兩種大小，否則使用單一規格
+        sized = {k: v for k, v in prices.items() if k != "單一規格" and v > 0}
+        if not sized and "單一規格" not in prices:
+            out["rejected"].append({**entry, "原因": "沒有價格"})
+            continue
+        if (store, item) in seen:
+            out["warnings"].append({**entry, "原因": f"與第 {seen[(store, item)]} 列重複，以此列為準"})
+        seen[(store, item)] = n
+        menus.setdefault(store, {})[item] = sized or {"單一規格": prices["單一規格"]}
+    
+    out["menus"] = menus
+    if not menus: out["error"] = "沒有有效的菜單列"
+    out["hash"] = hashlib.sha256(json.dumps(menus, ensure_ascii=False, separators=(",", ":")).encode()).hexdigest()
+    return out
+
+# 解析菜單 (回傳 menus, 錯誤訊息)
+def parse_menu_rows(rows):
+    compiled = compile_menu(rows)
+    return compiled["menus"] if not compiled["error"] else None, compiled["error"]
+
+# 解析加料
+def parse_topping_rows(rows):
+    if len(rows) < 2: return {}
+    
+    headers = [h.strip() for h in rows[0]]
+    idx_store = headers.index("店家") if "店家" in headers else -1
+    idx_name = -1
+    for k in ["加料品項", "品項"]:
+        if k in headers:
+            idx_name = headers.index(k)
+            break
+    idx_price = headers.index("價格") if "價格" in headers else -1
+    
+    if idx_store == -1 or idx_name == -1 or idx_price == -1: return {}
+    
+    toppings = {}
+    for row in rows[1:]:
+        if len(row) <= max(idx_store, idx_name, idx_price): continue
+        store, name = row[idx_store].strip(), row[idx_name].strip()
+        try: price = parse_price(row[idx_price])
+        except ValueError: continue
+        if store and name and price is not None:
+            if store not in toppings: toppings[store] = {}
+            toppings[store][name] = price
+    return toppings
+
+# 找出儲值表的姓名 / 餘額欄位 (找不到回傳 -1)
+def find_balance_cols(headers):
+    headers = [str(h).strip() for h in headers]
+    idx_name, idx_bal = -1, -1
+    for k in BALANCE_NAME_KEYS:
+        if k in headers:
+            idx_name = headers.index(k)
+            break
+    for k in BALANCE_VALUE_KEYS:
+        if k in headers:
+            idx_bal = headers.index(k)
+            break
+    return idx_name, idx_bal
+
+# 解析存款
+def parse_balance_rows(rows):
+    if len(rows) < 2: return {}
+    
+    idx_name, idx_bal = find_balance_cols(rows[0])
+    if idx_name == -1 or idx_bal == -1: return {}
+    
+    balances = {}
+    for row in rows[1:]:
+        if len(row) <= max(idx_name, idx_bal): continue
+        name = str(row[idx_name]).strip()
+        bal = str(row[idx_bal]).replace("$", "").replace(",", "").strip()
+        if name:
+            try: balances[name] = int(float(bal))
+            except: balances[name] = 0
+    return balances
+
+# 計算儲值表需要寫入的內容 (保留原順序，新增新人)；欄位辨識失敗回傳 None
+def plan_balance_update(bal_rows, update_map):
+    """
+    回傳 {"header", "i_name", "i_bal", "updates": [(資料列位置, 新餘額)], "appends": [新列]}，
+    資料列位置為 0 起算 (不含標題列)。只列出需要改寫的餘額儲存格。
+    """
+    header = list(bal_rows[0]) if bal_rows else ["姓名", "存款餘額"]
+    i_n, i_b = find_balance_cols(header)
+    if i_n == -1 or i_b == -1: return None
+    
+    upd = pd.Series({str(k).strip(): int(v) for k, v in update_map.items()}, dtype="int64")
+    body = bal_rows[1:] if bal_rows else []
+    names = pd.Series([r[i_n].strip() if len(r) > i_n else "" for r in body], dtype=object)
+    olds = pd.Series([r[i_b] if len(r) > i_b else "" for r in body], dtype=object)
+    
+    # 同名重複出現時，與原本逐列處理相同：每一列都更新
+    hit = names.isin(upd.index) & (names != "")
+    new_vals = names[hit].map(upd)
+    changed = new_vals.astype(str) != olds[hit].astype(str).str.replace(",", "").str.strip()
+    updates = list(zip(new_vals[changed].index.tolist(), new_vals[changed].tolist()))
+    
+    new_people = upd[~upd.index.isin(names[hit])]
+    width = max(i_n, i_b) + 1
+    appends = []
+    for nm, val in new_people.items():
+        nr = [""] * width
+        nr[i_n], nr[i_b] = nm, int(val)
+        appends.append(nr)
+    return {"header": header, "i_name": i_n, "i_bal": i_b, "updates": updates, "appends": appends}
+
+# 樂觀並行控制：寫入前比對每人目前的餘額與讀取時看到的餘額 (expected)
+def resolve_balance_targets(current, targets, expected=None):
+    """
+    current: 寫入當下的 {姓名: 餘額}；targets: 要寫入的 {姓名: 新餘額}。
+    目前值等於 expected (沒人動過) 或已等於目標值 (重試) 時照原目標寫入；
+    否則表示讀取後有人改過 (例如直接在 Sheet 儲值)，改為「目前值 + 這次的變動量」。
+    回傳 (實際寫入的 {姓名: 餘額}, {姓名: (預期值, 目前值, 寫入值)})。
+    """
+    final, conflicts = {}, {}
+    for nm, target in targets.items():
+        nm, target = str(nm).strip(), int(target)
+        if expected is None or nm not in expected:
+            final[nm] = target
+            continue
+        exp, cur = int(expected[nm]), int(current.get(nm, 0))
+        if cur in (exp, target):
+            final[nm] = target
+        else:
+            final[nm] = cur + (target - exp)
+            conflicts[nm] = (exp, cur, final[nm])
+    return final, conflicts
+
+# 儲存格值正規化：空值轉為 ""，整數金額統一為 int，其餘轉為字串
+def normalize_cell(v):
+    if v is None: return ""
+    if isinstance(v, numbers.Number) and not isinstance(v, bool):
+        if pd.isna(v): return ""
+        if isinstance(v, numbers.Integral) or float(v).is_integer(): return int(v)
+        return float(v)
+    if pd.isna(v) is True: return ""
+    if isinstance(v, datetime): return v.strftime(ORDER_TIME_FORMAT)
+    return str(v)
+
+# 比較快照中的訂單與編輯後的 DataFrame，算出逐列差異
+def diff_order_rows(headers, old_rows, new_df, base_df=None):
+    """
+    headers: Sheet 上完整的標題列；old_rows: 快照中的資料列 (不含標題)。
+    new_df 的 index 對應 old_rows 的位置：不在 new_df 中的舊列視為刪除，
+    index 不在舊列範圍內的列視為新增。欄位以標題名稱對應 Sheet 上的欄位位置。
+    base_df 為編輯前由 old_rows 解析出的 DataFrame (orders_frame)：值與解析後的原值相同的儲存格視為未修改，
+    不會把無法解析的原始內容 (非標準格式的時間、非數字的價格) 改寫成空白或 0。
+    回傳 {"updates": [(列, 欄, 值)], "deletes": [列], "appends": [整列]}，列 / 欄皆為 0 起算 (不含標題列)。
+    """
+    col_pos = {}
+    for i, h in enumerate(headers):
+        if h.strip() and h not in col_pos: col_pos[h] = i
+    cols = [c for c in new_df.columns if c in col_pos]
+    width = len(headers)
+    
+    updates, appends = [], []
+    kept = set()
+    for idx, row in zip(new_df.index, new_df[cols].itertuples(index=False, name=None)):
+        if isinstance(idx, numbers.Integral) and 0 <= idx < len(old_rows) and idx not in kept:
+            kept.add(idx)
+            old = old_rows[idx]
+            for c, v in zip(cols, row):
+                j = col_pos[c]
+                new_v = normalize_cell(v)
+                old_v = old[j] if j < len(old) else ""
+                if str(new_v) == str(old_v): continue
+                if base_df is not None and c in base_df.columns and idx in base_df.index \
+                        and new_v == normalize_cell(base_df.at[idx, c]):
+                    continue
+                updates.append((idx, j, new_v))
+        else:
+            full = [""] * width
+            for c, v in zip(cols, row): full[col_pos[c]] = normalize_cell(v)
+            appends.append(full)
+    
+    deletes = [i for i in range(len(old_rows)) if i not in kept]
+    return {"updates": updates, "deletes": deletes, "appends": appends}
+
+# 將差異套用到訂單二維陣列 (含標題列)，回傳新的陣列
+def apply_order_diff_to_grid(grid, diff):
+    header, rows = list(grid[0]), [list(r) for r in grid[1:]]
+    for r, c, v in diff["updates"]:
+        if r >= len(rows): continue
+        while len(rows[r]) <= c: rows[r].append("")
+        rows[r][c] = str(v)
+    for r in sorted(set(diff["deletes"]), reverse=True):
+        if r < len(rows): del rows[r]
+    rows.extend([str(v) for v in row] for row in diff["appends"])
+    return [header] + rows
+
+# 兩列內容是否相同 (忽略結尾空白儲存格；API 回傳的列會省略結尾空值)
+def same_row(a, b):
+    a, b = list(a), list(b)
+    while a and a[-1] == "": a.pop()
+    while b and b[-1] == "": b.pop()
+    return a == b
+
+# 找出訂單表中屬於已結算訂單的列 (0 起算、不含標題列)；同內容的訂單依出現次數逐一配對，
+# 結算後才新增的訂單不會被刪除，已刪除過的列也不會重複刪除 (可安全重試)
+def plan_order_removal(grid, settled_rows):
+    def key(r):
+        r = [str(v) for v in r]
+        while r and r[-1] == "": r.pop()
+        return tuple(r)
+    remaining = {}
+    for r in settled_rows:
+        remaining[key(r)] = remaining.get(key(r), 0) + 1
+    deletes = []
+    for i, r in enumerate(grid[1:]):
+        k = key(r)
+        if remaining.get(k):
+            remaining[k] -= 1
+            deletes.append(i)
+    return deletes
+
+# 訂單二維陣列 (含標題列) 轉為 DataFrame：略過空白標題，價格轉為數字；沒有有效標題時回傳 None
+def orders_frame(grid):
+    """
+    由訂單二維陣列 (含標題列) 建立有型別的 DataFrame，略過空白標題的欄位：
+    店家 / 品項 / 大小 / 甜度 / 冰塊 為 category，價格為 int，時間解析為 datetime (無法解析為 NaT)。
+    """
+    headers = grid[0] if grid else []
+    valid_idx = [i for i, h in enumerate(headers) if str(h).strip()]
+    if not valid_idx: return None
+    clean_headers = [headers[i] for i in valid_idx]
+    clean_rows = [[r[i] if i < len(r) else "" for i in valid_idx] for r in grid[1:]]
+    
+    df = pd.DataFrame(clean_rows, columns=clean_headers)
+    
+    # 確保價格為整數
+    for col in ['價格', 'Price']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).round().astype("int64")
+    for col in ORDER_CATEGORY_COLS:
+        if col in df.columns: df[col] = df[col].astype("category")
+    if '時間' in df.columns:
+        df['時間'] = pd.to_datetime(df['時間'], format=ORDER_TIME_FORMAT, errors='coerce')
+    return df
+
+# 樂觀並行控制：把依快照 (base_rows) 算出的差異對到目前的訂單列 (current_rows)
+def rebase_order_diff(base_rows, current_rows, diff):
+    """
+    被修改 / 刪除的每一列都要與快照內容相同才套用：位置沒變的直接套用，
+    因別人刪列而位移的依內容找回新位置，內容已被別人改掉或刪除的列視為衝突而略過。
+    新增列一律附加在最後。回傳 (新的差異, {"conflicts": [快照列位置], "moved": 位移列數})。
+    """
+    touched = sorted({r for r, _, _ in diff["updates"]} | set(diff["deletes"]))
+    mapping, used = {}, set()
+    for r in touched:
+        if r < len(base_rows) and r < len(current_rows) and same_row(current_rows[r], base_rows[r]):
+            mapping[r] = r
+            used.add(r)
+    conflicts, moved = [], 0
+    for r in touched:
+        if r in mapping: continue
+        j = None
+        if r < len(base_rows):
+            j = next((j for j, row in enumerate(current_rows) if j not in used and same_row(row, base_rows[r])), None)
+        if j is None:
+            conflicts.append(r)
+        else:
+            mapping[r] = j
+            used.add(j)
+            moved += 1
+    new_diff = {
+        "updates": [(mapping[r], c, v) for r, c, v in diff["updates"] if r in mapping],
+        "deletes": [mapping[r] for r in diff["deletes"] if r in mapping],
+        "appends": list(diff["appends"]),
+    }
+    return new_diff, {"conflicts": conflicts, "moved": moved}
+
+# 設定分頁的快取鍵與對應的分頁標題
+TAB_TITLES = {"menu": "菜單設定", "toppings": "加料設定", "balances": "會員儲值"}
+
+# 資料快照：本次執行使用的菜單與加料 (解析後)；訂單與會員儲值由各自的 fragment 從共用快取取得
+class DataSnapshot(NamedTuple):
+    menus: dict
+    menu_error: str
+    toppings: dict
+    versions: dict      # 各快取鍵的版本號，內容改變時遞增
+
+# --- 2-2. Google Sheet 物件快取 (Spreadsheet / Worksheet Handles) ---
+# open_by_url 與 worksheet() 每次都會先抓一次 metadata；這裡把 Spreadsheet 與各分頁物件留著重用，
+# 只有在分頁不存在或被改名 (API 回報找不到範圍) 時才重新取得。
+
+ORDER_SHEET = 0  # 訂單分頁以第一個分頁 (index 0) 識別
+
+# 判斷錯誤是否代表快取的分頁物件已失效 (分頁被刪除或改名)
+def is_stale_handle_error(e):
+    if isinstance(e, gspread.WorksheetNotFound):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        msg = str(e)
+        return getattr(e, "code", None) == 404 or "Unable to parse range" in msg
+    return False
+
+class SheetHandles:
+    def __init__(self, client, sheet_url):
+        self.client = client
+        self.sheet_url = sheet_url
+        self._lock = threading.Lock()
+        self._sh = None
+        self._ws = {}
+        self._titles = None
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._sh is None:
+                self._sh = self.client.open_by_url(self.sheet_url)
+            return self._sh
+
+    def worksheet(self, key):
+        """依標題 (或 index) 取得分頁物件，只在第一次使用時查詢。"""
+        with self._lock:
+            ws = self._ws.get(key)
+        if ws is not None: return ws
+        
+        sh = self.spreadsheet()
+        ws = sh.get_worksheet(key) if isinstance(key, int) else sh.worksheet(key)
+        if ws is None: raise gspread.WorksheetNotFound(str(key))
+        with self._lock:
+            self._ws[key] = ws
+        return ws
+
+    def titles(self):
+        """取得所有分頁標題；同時把所有分頁物件放進快取 (只需一次 metadata 請求)。"""
+        with self._lock:
+            if self._titles is not None: return self._titles
+        worksheets = self.spreadsheet().worksheets()
+        with self._lock:
+            for i, ws in enumerate(worksheets):
+                self._ws.setdefault(ws.title, ws)
+                if i == ORDER_SHEET: self._ws.setdefault(ORDER_SHEET, ws)
+            self._titles = [ws.title for ws in worksheets]
+            return self._titles
+
+    def batch_get(self, keys):
+        """
+        以單一 values_batch_get 讀取多個分頁的完整內容。
+        回傳 {key: 二維陣列}，不存在的分頁不會出現在結果中。
+        """
+        for attempt in range(2):
+            titles = self.titles()
+            wanted = {}
+            for key in keys:
+                if isinstance(key, int):
+                    if key < len(titles): wanted[key] = titles[key]
+                elif key in titles:
+                    wanted[key] = key
+            if not wanted: return {}
+            
+            ranges = [gspread.utils.absolute_range_name(t) for t in wanted.values()]
+            try:
+                resp = self.spreadsheet().values_batch_get(ranges)
+            except Exception as e:
+                # 分頁在兩次請求之間被改名或刪除：重新取得標題再試一次
+                if attempt == 0 and is_stale_handle_error(e):
+                    self.invalidate()
+                    continue
+                raise
+            value_ranges = resp.get("valueRanges", [])
+            return {key: gspread.utils.fill_gaps(vr.get("values", [[]]))
+                    for key, vr in zip(wanted.keys(), value_ranges)}
+
+    def modified_time(self):
+        """試算表最後修改時間 (Drive metadata，任何分頁被修改都會改變)。"""
+        return self.spreadsheet().get_lastUpdateTime()
+
+    def add_worksheet(self, title, rows, cols):
+        ws = self.spreadsheet().add_worksheet(title=title, rows=rows, cols=cols)
+        with self._lock:
+            self._ws[title] = ws
+            self._titles = None
+        return ws
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._titles = None
+            if key is None:
+                self._sh = None
+                self._ws.clear()
+            else:
+                self._ws.pop(key, None)
+
+    def run(self, key, fn):
+        """以分頁物件執行 fn(ws)；快取的分頁已失效時重新取得並重試一次。"""
+        with self._lock:
+            cached = key in self._ws
+        try:
+            return fn(self.worksheet(key))
+        except Exception as e:
+            if not cached or not is_stale_handle_error(e): raise
+            self.invalidate(key)
+            return fn(self.worksheet(key))
+
+# 取得共用的 Sheet 物件快取 (快取資源，建立在 get_google_client 之上)
+@st.cache_resource
+def get_sheet_handles(_client, sheet_url):
+    return SheetHandles(_client, sheet_url)
+
+# --- 2-3. 儲存後端 (Storage Backends) ---
+# 所有資料存取都透過後端介面，UI 與結算流程不直接操作 gspread。
+#   SheetsBackend : 直接讀寫 Google Sheet (預設)
+#   SQLiteBackend : 本機 SQLite 為主，Google Sheet 為定期同步的鏡像
+#   MemoryBackend : 記憶體內假資料，供測試 / 壓力測試使用
+# 由 Secrets 的 storage_backend = "sheets" | "sqlite" | "memory" 選擇。
+
+class StorageBackend:
+    name = "base"
+
+    def load_menu(self):
+        """回傳 (menus, 錯誤訊息)，menus 格式為 {店家: {品項: {大小: 價格}}}。"""
+        raise NotImplementedError
+
+    def load_toppings(self):
+        """回傳 {店家: {加料: 價格}}。"""
+        raise NotImplementedError
+
+    def load_balances(self):
+        """回傳 {姓名: 餘額}。"""
+        raise NotImplementedError
+
+    def menu_report(self):
+        """最近一次菜單編譯的快照 (見 MenuSnapshot)；不經過編譯步驟的後端回傳 None。"""
+        return None
+
+    def recompile_menu(self):
+        """下次讀取菜單時不論修改時間一律重新編譯。"""
+
+    def get_orders(self):
+        """回傳訂單二維陣列 (第一列為標題)，格式同 get_all_values()。"""
+        raise NotImplementedError
+
+    def get_order_tail(self, known):
+        """
+        known 為目前已有的訂單二維陣列；回傳其後新增的列 (list)。
+        若標題或已知的最後一列已變動 (被刪除 / 清空 / 改寫) 而無法接續，回傳 None。
+        """
+        grid = self.get_orders()
+        n = len(known)
+        if n == 0 or len(grid) < n: return None
+        if not same_row(grid[0], known[0]) or not same_row(grid[n - 1], known[n - 1]): return None
+        return grid[n:]
+
+    def load_tabs(self, keys):
+        """
+        讀取指定的設定分頁 (TAB_TITLES 的鍵)：
+        menu → (menus, 錯誤訊息)、toppings → dict、balances → dict。
+        """
+        out = {}
+        if "menu" in keys: out["menu"] = self.load_menu()
+        if "toppings" in keys: out["toppings"] = self.load_toppings()
+        if "balances" in keys: out["balances"] = self.load_balances()
+        return out
+
+    def append_orders(self, rows):
+        raise NotImplementedError
+
+    def replace_orders(self, headers, rows):
+        """以新的標題與資料整批取代訂單。"""
+        raise NotImplementedError
+
+    def apply_order_diff(self, diff, base_rows=None):
+        """
+        套用 diff_order_rows 算出的差異 (只更新變動的儲存格、刪除列與新增列)。
+        有給 base_rows (算差異時的快照資料列) 時先以 rebase_order_diff 檢查衝突，
+        回傳 {"conflicts": [未套用的快照列位置], "moved": 位移列數}。
+        """
+        grid = self.get_orders()
+        result = {"conflicts": [], "moved": 0}
+        if base_rows is not None: diff, result = rebase_order_diff(base_rows, grid[1:], diff)
+        grid = apply_order_diff_to_grid(grid, diff)
+        self.replace_orders(grid[0], grid[1:])
+        return result
+
+    def update_balances(self, update_map):
+        """更新 {姓名: 新餘額} (直接覆寫)，欄位辨識失敗回傳 False。"""
+        return self.apply_balance_changes(update_map) is not None
+
+    def apply_balance_changes(self, targets, expected=None, on_resolved=None):
+        """
+        寫入 {姓名: 新餘額}；有給 expected (讀取時看到的餘額) 時以 resolve_balance_targets 處理衝突。
+        on_resolved(final, conflicts) 在決定實際寫入的值之後、寫入之前呼叫 (例如先寫入結算日誌)。
+        回傳 {"final": 實際寫入的餘額, "conflicts": 衝突的人}；欄位辨識失敗回傳 None。
+        """
+        raise NotImplementedError
+
+    def log_transaction(self, name, amount_change, new_balance, note="", ts=None):
+        raise NotImplementedError
+
+    def log_transactions(self, entries):
+        """
+        批次寫入交易紀錄。entries 為 {"name", "change", "bal", "note", "ts"(選填)} 的 list，
+        回傳與 entries 對應的成功與否 (list of bool)。
+        """
+        return [self.log_transaction(e["name"], e["change"], e["bal"], e.get("note", ""), ts=e.get("ts"))
+                for e in entries]
+
+
+# 交易紀錄 dict 轉為寫入用的一列 (DataFrame 的 numpy 整數需轉為 int 才能序列化)
+def log_entry_row(entry, ts):
+    return [entry.get("ts") or ts, str(entry["name"]), int(entry["change"]), int(entry["bal"]), str(entry.get("note", ""))]
+
+
+# 菜單快照：compile_menu 的結果連同內容雜湊、版本號與來源修改時間寫成 JSON。
+# 程序重啟時直接載入；試算表修改時間與快照相同就不重新讀取菜單分頁，
+# 重新編譯後內容雜湊不變時版本號也不變。
+class MenuSnapshot:
+    def __init__(self, path=MENU_SNAPSHOT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snap = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return snap if snap.get("format") == MENU_SNAPSHOT_FORMAT else None
+
+    def current(self):
+        with self._lock:
+            return self._snap
+
+    def update(self, compiled, modified):
+        """寫入新的編譯結果並回傳快照；modified 為讀取前查到的試算表修改時間 (None 表示未知)。"""
+        with self._lock:
+            prev = self._snap
+            same = prev is not None and prev["hash"] == compiled["hash"]
+            snap = {"format": MENU_SNAPSHOT_FORMAT, "version": (prev["version"] if prev else 0) + (0 if same else 1),
+                    "compiled_at": datetime.now().strftime(ORDER_TIME_FORMAT), "source_modified": modified, **compiled}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snap, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+            self._snap = snap
+            return snap
+
+class SheetsBackend(StorageBackend):
+    name = "sheets"
+
+    def __init__(self, client, sheet_url, handles=None, menu_snapshot=None):
+        self.client = client
+        self.sheet_url = sheet_url
+        self.handles = handles or SheetHandles(client, sheet_url)
+        self.menu_snapshot = menu_snapshot
+        self._menu_checked = 0.0
+
+    # 分頁不存在時回傳空資料；API 錯誤 (已在 HTTP 層限速重試過) 直接拋出，
+    # 避免呼叫端把暫時讀不到當成「沒有資料」而覆蓋掉快取或本機副本
+    def load_menu(self):
+        try:
+            rows = self.handles.run("菜單設定", lambda ws: ws.get_all_values())
+        except gspread.WorksheetNotFound:
+            return None, "找不到「菜單設定」分頁"
+        return parse_menu_rows(rows)
+
+    def load_toppings(self):
+        try:
+            return parse_topping_rows(self.handles.run("加料設定", lambda ws: ws.get_all_values()))
+        except gspread.WorksheetNotFound:
+            return {}
+
+    def load_balances(self):
+        try:
+            return parse_balance_rows(self.handles.run("會員儲值", lambda ws: ws.get_all_values()))
+        except gspread.WorksheetNotFound:
+            return {}
+
+    def get_orders(self):
+        return self.handles.run(ORDER_SHEET, lambda ws: ws.get_all_values())
+
+    def get_order_tail(self, known):
+        """
+        只讀取已知列數之後的新訂單：一次 values_batch_get 取得標題列、已知的最後一列與其後的範圍，
+        前兩者用來確認 Sheet 沒有被清空或刪列 (否則回傳 None 由呼叫端整表重讀)。
+        """
+        n = len(known)
+        if n == 0: return None
+        width = max(len(known[0]), 1)
+        last_col = gspread.utils.rowcol_to_a1(1, width).rstrip("0123456789")
+        
+        def read(ws):
+            t = ws.title
+            ranges = [gspread.utils.absolute_range_name(t, "1:1"),
+                      gspread.utils.absolute_range_name(t, f"A{n}:{last_col}{n}"),
+                      gspread.utils.absolute_range_name(t, f"A{n + 1}:{last_col}")]
+            return self.handles.spreadsheet().values_batch_get(ranges).get("valueRanges", [])
+        
+        vr = self.handles.run(ORDER_SHEET, read)
+        header = (vr[0].get("values") or [[]])[0]
+        last = (vr[1].get("values") or [[]])[0]
+        if not same_row(header, known[0]) or not same_row(last, known[n - 1]): return None
+        tail = vr[2].get("values", [])
+        return [r + [""] * (width - len(r)) for r in tail]
+
+    def menu_report(self):
+        return self.menu_snapshot.current() if self.menu_snapshot else None
+
+    def recompile_menu(self):
+        self._menu_checked = -1.0
+
+    def _cached_menu(self):
+        """
+        菜單快照仍可用時回傳 (快照, None)，否則回傳 (None, 修改時間) 表示需要重新編譯。
+        試算表修改時間最多每 MENU_CHECK_INTERVAL 秒查詢一次；查詢失敗時視為已修改。
+        """
+        snap = self.menu_snapshot.current()
+        now = time.time()
+        if snap and self._menu_checked > 0 and now - self._menu_checked < MENU_CHECK_INTERVAL:
+            return snap, None
+        try:
+            modified = self.handles.modified_time()
+        except Exception as e:
+            print(f"Menu Modified Time Error: {e}")
+            modified = None
+        if snap and modified and snap["source_modified"] == modified and self._menu_checked >= 0:
+            self._menu_checked = now
+            return snap, None
+        return None, modified
+
+    def load_tabs(self, keys):
+        """
+        以一次 values_batch_get 讀取指定的設定分頁；API 錯誤直接拋出，由快取保留舊資料。
+        有菜單快照時，試算表修改時間沒變就沿用快照，不讀取菜單分頁。
+        """
+        keys, out, modified = list(keys), {}, None
+        if "menu" in keys and self.menu_snapshot:
+            snap, modified = self._cached_menu()
+            if snap:
+                out["menu"] = (snap["menus"] if not snap["error"] else None, snap["error"])
+                keys.remove("menu")
+        grids = self.handles.batch_get([TAB_TITLES[k] for k in keys]) if keys else {}
+        for k in keys:
+            rows = grids.get(TAB_TITLES[k])
+            if k == "menu" and rows is not None and self.menu_snapshot:
+                snap = self.menu_snapshot.update(compile_menu(rows), modified)
+                self._menu_checked = time.time()
+                out[k] = (snap["menus"] if not snap["error"] else None, snap["error"])
+            elif k == "menu":
+                out[k] = parse_menu_rows(rows) if rows is not None else (None, "找不到「菜單設定」分頁")
+            elif k == "toppings":
+                out[k] = parse_topping_rows(rows) if rows else {}
+            elif k == "balances":
+                out[k] = parse_balance_rows(rows) if rows is not None else None
+        return out
+
+    def append_orders(self, rows):
+        self.handles.run(ORDER_SHEET, lambda ws: ws.append_rows(rows))
+
+    def replace_orders(self, headers, rows):
+        def write(ws):
+            ws.clear()
+            ws.update(values=[headers] + rows)
+        self.handles.run(ORDER_SHEET, write)
+
+    def apply_order_diff(self, diff, base_rows=None):
+        """
+        以單一 spreadsheets.batchUpdate 套用差異：先改儲存格，再由下往上刪列，最後 appendCells。
+        其他人在讀取快照之後新增的訂單位於快照範圍之外，不會被覆蓋；有給 base_rows 時
+        先重讀訂單表比對被改動的列，只略過與快照不符的列 (見 rebase_order_diff)。
+        """
+        def cell(v):
+            if isinstance(v, numbers.Number): return {"userEnteredValue": {"numberValue": v}}
+            return {"userEnteredValue": {"stringValue": str(v)}}
+
+        def write(ws):
+            d, result = diff, {"conflicts": [], "moved": 0}
+            if base_rows is not None: d, result = rebase_order_diff(base_rows, ws.get_all_values()[1:], diff)
+            reqs = []
+            for r, c, v in d["updates"]:
+                reqs.append({"updateCells": {
+                    "range": {"sheetId": ws.id, "startRowIndex": r + 1, "endRowIndex": r + 2,
+                              "startColumnIndex": c, "endColumnIndex": c + 1},
+                    "rows": [{"values": [cell(v)]}],
+                    "fields": "userEnteredValue",
+                }})
+            # 連續的刪除列合併成一個範圍，由下往上刪以免位移
+            spans = []
+            for r in sorted(set(d["deletes"]), reverse=True):
+                if spans and spans[-1][0] == r + 1: spans[-1][0] = r
+                else: spans.append([r, r + 1])
+            if spans:
+                # 先在表尾補上等量的空白列：表格大小不變，刪光所有資料列時也不會觸發「不可刪除所有未凍結列」
+                reqs.append({"appendDimension": {"sheetId": ws.id, "dimension": "ROWS", "length": len(set(d["deletes"]))}})
+            for start, end in spans:
+                reqs.append({"deleteDimension": {
+                    "range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": start + 1, "endIndex": end + 1},
+                }})
+            if d["appends"]:
+                reqs.append({"appendCells": {
+                    "sheetId": ws.id,
+                    "rows": [{"values": [cell(v) for v in row]} for row in d["appends"]],
+                    "fields": "userEnteredValue",
+                }})
+            if reqs: self.handles.spreadsheet().batch_update({"requests": reqs})
+            return result
+        return self.handles.run(ORDER_SHEET, write)
+
+    def apply_balance_changes(self, targets, expected=None, on_resolved=None):
+        """
+        讀取目前的儲值表、比對 expected 後，只改寫餘額有變動的儲存格並附加新人，
+        全部在一次 values batchUpdate 中完成 (不清空分頁)。
+        """
+        def write(ws_bal):
+            bal_rows = ws_bal.get_all_values()
+            final, conflicts = resolve_balance_targets(parse_balance_rows(bal_rows), targets, expected)
+            plan = plan_balance_update(bal_rows, final)
+            if plan is None: return None
+            if on_resolved: on_resolved(final, conflicts)
+            
+            col = gspread.utils.rowcol_to_a1(1, plan["i_bal"] + 1).rstrip("0123456789")
+            data = []
+            if not bal_rows:
+                data.append({"range": "A1", "values": [plan["header"]]})
+            for r, val in plan["updates"]:
+                data.append({"range": f"{col}{r + 2}", "values": [[val]]})
+            if plan["appends"]:
+                start = max(len(bal_rows), 1) + 1
+                data.append({"range": f"A{start}", "values": plan["appends"]})
+            if data: ws_bal.batch_update(data)
+            return {"final": final, "conflicts": conflicts}
+        return self.handles.run("會員儲值", write)
+
+    def _log_ws(self):
+        try:
+            return self.handles.worksheet("交易紀錄")
+        except gspread.WorksheetNotFound:
+            ws_log = self.handles.add_worksheet("交易紀錄", rows=1000, cols=5)
+            ws_log.append_row(LOG_HEADERS)
+            return ws_log
+
+    def log_transaction(self, name, amount_change, new_balance, note="", ts=None):
+        entry = {"name": name, "change": amount_change, "bal": new_balance, "note": note, "ts": ts}
+        return self.log_transactions([entry])[0]
+
+    def log_transactions(self, entries):
+        """所有紀錄合併為一次 append_rows (429 由 HTTP 層重試)。"""
+        if not entries: return []
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [log_entry_row(e, ts) for e in entries]
+        try:
+            self._log_ws()
+            self.handles.run("交易紀錄", lambda ws: ws.append_rows(rows))
+            return [True] * len(rows)
+        except Exception as e:
+            print(f"Log Error: {e}")
+            return [False] * len(rows)
+
+
+class MemoryBackend(StorageBackend):
+    name = "memory"
+
+    def __init__(self, menus=None, toppings=None, balances=None, orders=None):
+        self.menus = menus if menus is not None else DEFAULT_MENUS
+        self.toppings = toppings or {}
+        self.balances = dict(balances or {})
+        self.orders = [list(r) for r in (orders or [ORDER_HEADERS])]
+        self.transactions = []
+        # apply_order_diff 持鎖時會再呼叫 get_orders / replace_orders，因此用可重入鎖
+        self._lock = threading.RLock()
+
+    def load_menu(self):
+        return (self.menus, None) if self.menus else (None, "無資料")
+
+    def load_toppings(self):
+        return self.toppings
+
+    def load_balances(self):
+        with self._lock:
+            return dict(self.balances)
+
+    def get_orders(self):
+        with self._lock:
+            return [list(r) for r in self.orders]
+
+    def append_orders(self, rows):
+        with self._lock:
+            self.orders.extend([str(v) for v in r] for r in rows)
+
+    def replace_orders(self, headers, rows):
+        with self._lock:
+            self.orders = [list(headers)] + [[str(v) for v in r] for r in rows]
+
+    def apply_order_diff(self, diff, base_rows=None):
+        with self._lock:
+            return super().apply_order_diff(diff, base_rows)
+
+    def apply_balance_changes(self, targets, expected=None, on_resolved=None):
+        with self._lock:
+            final, conflicts = resolve_balance_targets(self.balances, targets, expected)
+            if on_resolved: on_resolved(final, conflicts)
+            self.balances.update(final)
+        return {"final": final, "conflicts": conflicts}
+
+    def log_transaction(self, name, amount_change, new_balance, note="", ts=None):
+        entry = {"name": name, "change": amount_change, "bal": new_balance, "note": note, "ts": ts}
+        return self.log_transactions([entry])[0]
+
+    def log_transactions(self, entries):
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self.transactions.extend(log_entry_row(e, ts) for e in entries)
+        return [True] * len(entries)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS menu (store TEXT, item TEXT, size TEXT, price INTEGER, pos INTEGER,
+                                 PRIMARY KEY (store, item, size));
+CREATE TABLE IF NOT EXISTS toppings (store TEXT, name TEXT, price INTEGER, pos INTEGER,
+                                     PRIMARY KEY (store, name));
+CREATE TABLE IF NOT EXISTS balances (name TEXT PRIMARY KEY, balance INTEGER NOT NULL, pos INTEGER);
+CREATE TABLE IF NOT EXISTS orders (seq INTEGER PRIMARY KEY AUTOINCREMENT, row_json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS transactions (seq INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT, name TEXT,
+                                         change INTEGER, balance INTEGER, note TEXT,
+                                         synced INTEGER NOT NULL DEFAULT 0);
+"""
+
+class SQLiteBackend(StorageBackend):
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._mirror = None
+
+    # --- meta ---
+    def _get_meta(self, key, default=None):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _bump(self, key):
+        # 本機資料版本號，用來判斷是否需要同步到 Sheet
+        self._set_meta(key, int(self._get_meta(key, 0)) + 1)
+
+    def is_initialized(self):
+        with self._lock:
+            return self._get_meta("initialized") == "1"
+
+    # --- 讀取 ---
+    def load_menu(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT store, item, size, price FROM menu ORDER BY pos").fetchall()
+        if not rows: return None, "無資料"
+        menus = {}
+        for store, item, size, price in rows:
+            menus.setdefault(store, {}).setdefault(item, {})[size] = price
+        return menus, None
+
+    def load_toppings(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT store, name, price FROM toppings ORDER BY pos").fetchall()
+        toppings = {}
+        for store, name, price in rows:
+            toppings.setdefault(store, {})[name] = price
+        return toppings
+
+    def load_balances(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT name, balance FROM balances ORDER BY pos").fetchall()
+        return {name: bal for name, bal in rows}
+
+    def get_orders(self):
+        with self._lock:
+            headers = json.loads(self._get_meta("order_headers", json.dumps(ORDER_HEADERS)))
+            rows = self._conn.execute("SELECT row_json FROM orders ORDER BY seq").fetchall()
+        return [headers] + [json.loads(r[0]) for r in rows]
+
+    # --- 寫入 ---
+    def save_menu(self, menus):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM menu")
+            pos = 0
+            for store, items in menus.items():
+                for item, sizes in items.items():
+                    for size, price in sizes.items():
+                        self._conn.execute("INSERT INTO menu VALUES (?, ?, ?, ?, ?)", (store, item, size, int(price), pos))
+                        pos += 1
+
+    def save_toppings(self, toppings):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM toppings")
+            pos = 0
+            for store, tops in toppings.items():
+                for name, price in tops.items():
+                    self._conn.execute("INSERT INTO toppings VALUES (?, ?, ?, ?)", (store, name, int(price), pos))
+                    pos += 1
+
+    def save_balances(self, balances):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM balances")
+            self._conn.executemany("INSERT INTO balances VALUES (?, ?, ?)",
+                                   [(nm, int(v), i) for i, (nm, v) in enumerate(balances.items())])
+
+    def append_orders(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO orders (row_json) VALUES (?)",
+                                   [(json.dumps([str(v) for v in r], ensure_ascii=False),) for r in rows])
+            self._bump("orders_rev")
+
+    def replace_orders(self, headers, rows):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM orders")
+            self._set_meta("order_headers", json.dumps(list(headers), ensure_ascii=False))
+            self._conn.executemany("INSERT INTO orders (row_json) VALUES (?)",
+                                   [(json.dumps([str(v) for v in r], ensure_ascii=False),) for r in rows])
+            self._bump("orders_rev")
+
+    def apply_order_diff(self, diff, base_rows=None):
+        # 持有鎖，避免背景寫入的新訂單在讀取與覆寫之間遺失
+        with self._lock:
+            return super().apply_order_diff(diff, base_rows)
+
+    def _write_balances(self, update_map):
+        pos = self._conn.execute("SELECT COALESCE(MAX(pos), -1) FROM balances").fetchone()[0]
+        # 既有的人只更新餘額 (保留 pos)，新人依序排在最後
+        self._conn.executemany(
+            "INSERT INTO balances (name, balance, pos) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET balance = excluded.balance",
+            [(nm, int(val), pos + 1 + i) for i, (nm, val) in enumerate(update_map.items())])
+        self._bump("balances_rev")
+
+    def _write_logs(self, entries):
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._conn.executemany("INSERT INTO transactions (ts, name, change, balance, note) VALUES (?, ?, ?, ?, ?)",
+                               [log_entry_row(e, ts) for e in entries])
+
+    def apply_balance_changes(self, targets, expected=None, on_resolved=None):
+        # 比對與寫入在同一個鎖與交易內，不會有其他寫入插進來
+        with self._lock, self._conn:
+            current = dict(self._conn.execute("SELECT name, balance FROM balances").fetchall())
+            final, conflicts = resolve_balance_targets(current, targets, expected)
+            if on_resolved: on_resolved(final, conflicts)
+            self._write_balances(final)
+        return {"final": final, "conflicts": conflicts}
+
+    def log_transaction(self, name, amount_change, new_balance, note="", ts=None):
+        entry = {"name": name, "change": amount_change, "bal": new_balance, "note": note, "ts": ts}
+        return self.log_transactions([entry])[0]
+
+    def log_transactions(self, entries):
+        with self._lock, self._conn:
+            self._write_logs(entries)
+        return [True] * len(entries)
+
+    # --- 與 Google Sheet 同步 ---
+    def import_from(self, sheets):
+        """第一次啟動時，從 Sheet 匯入全部資料。"""
+        menus, _ = sheets.load_menu()
+        if menus: self.save_menu(menus)
+        self.save_toppings(sheets.load_toppings())
+        self.save_balances(sheets.load_balances())
+        orders = sheets.get_orders()
+        if orders: self.replace_orders(orders[0], orders[1:])
+        with self._lock, self._conn:
+            self._set_meta("orders_synced_rev", self._get_meta("orders_rev", 0))
+            self._set_meta("balances_synced_rev", self._get_meta("balances_rev", 0))
+            self._set_meta("initialized", "1")
+
+    def sync_with(self, sheets):
+        """
+        菜單 / 加料：以 Sheet 為準 (管理者直接在 Sheet 編輯)。
+        訂單 / 交易紀錄：以本機為準，推送到 Sheet。
+        餘額：本機有未同步的變更時推送，否則從 Sheet 拉回 (保留直接在 Sheet 儲值的金額)。
+        """
+        menus, _ = sheets.load_menu()
+        if menus: self.save_menu(menus)
+        self.save_toppings(sheets.load_toppings())
+
+        with self._lock:
+            o_rev = self._get_meta("orders_rev", "0")
+            o_synced = self._get_meta("orders_synced_rev", "0")
+        if o_rev != o_synced:
+            orders = self.get_orders()
+            sheets.replace_orders(orders[0], orders[1:])
+            with self._lock, self._conn: self._set_meta("orders_synced_rev", o_rev)
+
+        with self._lock:
+            pending_logs = self._conn.execute(
+                "SELECT seq, ts, name, change, balance, note FROM transactions WHERE synced = 0 ORDER BY seq").fetchall()
+        if pending_logs:
+            entries = [{"ts": ts, "name": name, "change": change, "bal": bal, "note": note}
+                       for _, ts, name, change, bal, note in pending_logs]
+            results = sheets.log_transactions(entries)
+            done = [(row[0],) for row, ok in zip(pending_logs, results) if ok]
+            with self._lock, self._conn:
+                self._conn.executemany("UPDATE transactions SET synced = 1 WHERE seq = ?", done)
+
+        with self._lock:
+            b_rev = self._get_meta("balances_rev", "0")
+            b_synced = self._get_meta("balances_synced_rev", "0")
+        if b_rev != b_synced:
+            if sheets.update_balances(self.load_balances()):
+                with self._lock, self._conn: self._set_meta("balances_synced_rev", b_rev)
+        else:
+            remote = sheets.load_balances()
+            with self._lock, self._conn:
+                # 同步期間本機若有新變更，這次就不覆蓋
+                if remote and self._get_meta("balances_rev", "0") == b_rev:
+                    self._conn.execute("DELETE FROM balances")
+                    self._conn.executemany("INSERT INTO balances VALUES (?, ?, ?)",
+                                           [(nm, int(v), i) for i, (nm, v) in enumerate(remote.items())])
+
+    def start_mirror(self, sheets, interval=SHEET_SYNC_INTERVAL):
+        """啟動背景執行緒，定期把本機資料同步到 Google Sheet 鏡像。"""
+        if self._mirror: return
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync_with(sheets)
+                except Exception as e:
+                    print(f"Sheet Mirror Error: {e}")
+        self._mirror = threading.Thread(target=loop, name="sheet-mirror", daemon=True)
+        self._mirror.start()
+
+
+# 依群組設定建立儲存後端 (快取資源，每個試算表一個)
+@st.cache_resource
+def get_storage_backend(_client, sheet_url, kind="sheets", sqlite_path=SQLITE_PATH, menu_path=MENU_SNAPSHOT_PATH):
+    sheets = SheetsBackend(_client, sheet_url, get_sheet_handles(_client, sheet_url), MenuSnapshot(menu_path))
+    if kind == "sqlite":
+        local = SQLiteBackend(sqlite_path)
+        if not local.is_initialized(): local.import_from(sheets)
+        local.start_mirror(sheets, SHEET_SYNC_INTERVAL)
+        return local
+    if kind == "memory":
+        return MemoryBackend()
+    return sheets
+
+# --- 2-4. 全程序共用快取 (Shared Cache) ---
+# 所有 session 共用同一份資料，每個快取鍵 (menu / toppings / balances / orders) 各自有版本號與計數器。
+#   - 冷資料 (尚無任何值)：同步讀取，同一群組同時只讀一次
+#   - 過期資料：立即回傳舊值，並在背景重新讀取 (stale-while-revalidate)
+#   - 寫入後：以 put() 直接放入已知的新值 (版本號 +1)，再於背景向後端確認
+
+class SharedCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}       # key -> {"value", "version", "fetched_at", "written_at"}
+        self._groups = {}        # key -> 讀取群組 (同群組的鍵以同一個 loader 一起讀取)
+        self._refreshing = set()
+        self._stats = {}
+        self._listeners = []
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+
+    def register(self, keys, loader, max_age, on_error=None):
+        """
+        loader(keys, current) 回傳 {key: value}；current 為這些鍵目前的快取值 (可能為 None)。
+        on_error(key, exc) 在冷資料讀取失敗時提供暫時的替代值 (不寫入快取)。
+        """
+        group = {"loader": loader, "max_age": max_age, "on_error": on_error, "load_lock": threading.Lock()}
+        for k in keys:
+            self._groups[k] = group
+            self._stats[k] = {"hit": 0, "miss": 0, "stale": 0, "refresh": 0, "error": 0}
+
+    def subscribe(self, listener):
+        """listener(key, old, new, version) 在快取值改變後呼叫 (讀取或 put 的執行緒上，不持有鎖)。"""
+        self._listeners.append(listener)
+
+    def _by_group(self, keys):
+        groups = {}
+        for k in keys:
+            g = self._groups[k]
+            groups.setdefault(id(g), (g, []))[1].append(k)
+        return groups.values()
+
+    def _store(self, key, value, started, force=False):
+        with self._lock:
+            e = self._entries.get(key)
+            # 讀取期間已有較新的 put()，這次讀到的資料較舊，不覆蓋
+            if e is not None and not force and e["written_at"] > started: return
+            changed = force or e is None or e["value"] != value
+            version = (e["version"] if e else 0) + (1 if changed else 0)
+            self._entries[key] = {"value": value, "version": version, "fetched_at": time.time(),
+                                  "written_at": time.time() if force else started}
+        if not changed: return
+        for listener in self._listeners:
+            try: listener(key, e["value"] if e else None, value, version)
+            except Exception as exc: print(f"Cache Listener Error ({key}): {exc}")
+
+    def get(self, keys):
+        now = time.time()
+        result, missing, stale = {}, [], []
+        with self._lock:
+            for k in keys:
+                e = self._entries.get(k)
+                if e is None:
+                    missing.append(k)
+                    self._stats[k]["miss"] += 1
+                    continue
+                result[k] = e["value"]
+                if now - e["fetched_at"] >= self._groups[k]["max_age"]:
+                    stale.append(k)
+                    self._stats[k]["stale"] += 1
+                else:
+                    self._stats[k]["hit"] += 1
+        for g, ks in self._by_group(missing):
+            result.update(self._load_sync(g, ks))
+        for g, ks in self._by_group(stale):
+            self._schedule(g, ks)
+        return result
+
+    def value(self, key):
+        return self.get([key])[key]
+
+    def peek(self, key):
+        """取得目前的快取值 (不觸發讀取，也不計入統計)。"""
+        with self._lock:
+            e = self._entries.get(key)
+            return e["value"] if e else None
+
+    def version(self, key):
+        with self._lock:
+            e = self._entries.get(key)
+            return e["version"] if e else 0
+
+    def current(self, key):
+        """一次取得 (版本, 值)，不觸發讀取也不計入統計；尚未讀取過時回傳 None。"""
+        with self._lock:
+            e = self._entries.get(key)
+            return (e["version"], e["value"]) if e else None
+
+    def refresh_if_stale(self, key):
+        """過期時在背景重新讀取 (不計入統計)，回傳是否排入讀取。"""
+        with self._lock:
+            e = self._entries.get(key)
+            stale = e is not None and time.time() - e["fetched_at"] >= self._groups[key]["max_age"]
+        if stale: self._schedule(self._groups[key], [key])
+        return stale
+
+    def _load_sync(self, group, keys):
+        with group["load_lock"]:
+            with self._lock:
+                ready = {k: self._entries[k]["value"] for k in keys if k in self._entries}
+            todo = [k for k in keys if k not in ready]
+            if not todo: return ready
+            started = time.time()
+            try:
+                values = group["loader"](todo, {k: None for k in todo})
+                for k in todo: self._store(k, values[k], started)
+                ready.update({k: values[k] for k in todo})
+            except Exception as e:
+                print(f"Cache Load Error ({', '.join(todo)}): {e}")
+                with self._lock:
+                    for k in todo: self._stats[k]["error"] += 1
+                on_error = group["on_error"] or (lambda k, exc: None)
+                ready.update({k: on_error(k, e) for k in todo})
+            return ready
+
+    def _schedule(self, group, keys):
+        with self._lock:
+            keys = [k for k in keys if k not in self._refreshing]
+            self._refreshing.update(keys)
+        if keys: self._pool.submit(self._refresh, group, keys)
+
+    def _refresh(self, group, keys):
+        started = time.time()
+        try:
+            with group["load_lock"]:
+                values = group["loader"](keys, {k: self.peek(k) for k in keys})
+            for k in keys: self._store(k, values[k], started)
+            with self._lock:
+                for k in keys: self._stats[k]["refresh"] += 1
+        except Exception as e:
+            # 讀取失敗時保留舊資料，下次讀取再重試
+            print(f"Cache Refresh Error ({', '.join(keys)}): {e}")
+            with self._lock:
+                for k in keys: self._stats[k]["error"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+
+    def put(self, key, value, revalidate=True):
+        """寫入後直接放入新值；revalidate 時在背景向後端重新確認。"""
+        self._store(key, value, time.time(), force=True)
+        if revalidate: self.invalidate(key)
+
+    def invalidate(self, key):
+        """標記為過期並立即在背景重新讀取；讀取期間其他 session 仍回傳現有資料。"""
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None: return
+            e["fetched_at"] = 0.0
+        self._schedule(self._groups[key], [key])
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            out = []
+            for k, st_ in self._stats.items():
+                e = self._entries.get(k)
+                out.append({"key": k, "version": e["version"] if e else 0,
+                            "age_s": round(now - e["fetched_at"], 1) if e and e["fetched_at"] else None,
+                            **st_})
+            return out
+
+
+# 訂單增量讀取：記住已讀到的訂單，只讀取新增的尾端列；
+# Sheet 縮短、標題改變或每 ORDER_FULL_RELOAD 秒才重新讀取全部訂單。
+class OrderFeed:
+    def __init__(self, backend):
+        self.backend = backend
+        self._full_at = 0.0
+
+    def poll(self, known):
+        now = time.time()
+        tail = None
+        if known and now - self._full_at < ORDER_FULL_RELOAD:
+            try:
+                tail = self.backend.get_order_tail(known)
+            except Exception as e:
+                print(f"Order Poll Error: {e}")
+        if tail is None:
+            grid = self.backend.get_orders()
+            # 讀到完全空白的訂單表 (連標題列都沒有) 而先前有資料時，視為讀取異常並保留舊資料
+            if not grid and known: raise RuntimeError("讀取訂單失敗")
+            self._full_at = now
+            return grid
+        return known + tail if tail else known
+
+    def invalidate(self):
+        """訂單被修改或清空：下次輪詢時整表重讀。"""
+        self._full_at = 0.0
+
+# 冷資料讀取失敗時的替代值
+def cache_fallback(key, exc):
+    if key == "menu": return None, str(exc)
+    if key == "toppings": return {}
+    if key == "orders": return []
+    return None
+
+@st.cache_resource
+def get_order_feed(_backend, sheet_url):
+    return OrderFeed(_backend)
+
+# 取得共用快取 (快取資源)
+@st.cache_resource
+def get_shared_cache(_backend, sheet_url):
+    cache = SharedCache()
+    feed = get_order_feed(_backend, sheet_url)
+    cache.register(list(TAB_TITLES), lambda keys, current: _backend.load_tabs(keys),
+                   SETTINGS_MAX_AGE, on_error=cache_fallback)
+    cache.register(["orders"], lambda keys, current: {"orders": feed.poll(current.get("orders"))},
+                   ORDER_POLL_INTERVAL, on_error=cache_fallback)
+    return cache
+
+# 訂單推播 (程序內 pub/sub)：訂單快取改變 (送出寫入、管理員修改、結算、背景輪詢讀到 Sheet 的變動)
+# 或寫入佇列改變時發布一筆事件並遞增序號；各 session 的訂單列表只比對序號、讀取記憶體中的共用狀態，
+# 不會各自讀取 Sheet。Streamlit 無法由伺服器主動推送到頁面，新訂單提示以短間隔取得序號之後的事件。
+class OrderBroadcast:
+    def __init__(self, keep=100):
+        self._lock = threading.Lock()
+        self.seq = 0
+        self._events = deque(maxlen=keep)
+        self._watched_at = 0.0
+
+    def publish(self, kind, rows=()):
+        """kind："append" (尾端新增 rows)、"replace" (修改 / 刪除 / 清空，請重讀共用狀態)、"pending" (佇列改變)。"""
+        with self._lock:
+            self.seq += 1
+            self._events.append({"seq": self.seq, "kind": kind, "rows": [list(r) for r in rows], "at": time.time()})
+            return self.seq
+
+    def since(self, seq):
+        """序號 seq 之後的事件 (只保留最近 keep 筆)。"""
+        with self._lock:
+            return [e for e in self._events if e["seq"] > seq]
+
+    def last_event_at(self):
+        with self._lock:
+            return self._events[-1]["at"] if self._events else None
+
+    def watch(self):
+        """訂單列表每次更新時呼叫；有人檢視時背景輪詢才繼續讀取 Sheet。"""
+        self._watched_at = time.time()
+
+    def watched(self, within=ORDER_WATCH_IDLE):
+        return time.time() - self._watched_at < within
+
+def live_order_rows(events):
+    """
+    由推播事件整理出新訂單 (依出現順序)：回傳 ([(狀態, 訂單列)], 是否有修改 / 刪除)。
+    同一筆訂單送出時 (pending) 與寫入 Sheet 後 (append) 各有一個事件，以內容合併為一列。
+    """
+    rows, replaced = {}, False
+    for e in events:
+        if e["kind"] == "replace": replaced = True
+        for r in e["rows"]:
+            key = tuple(str(v) for v in r)
+            if e["kind"] == "append" or key not in rows:
+                rows[key] = ("✅ 已送出" if e["kind"] == "append" else "⏳ 等待寫入", list(key))
+    return list(rows.values()), replaced
+
+def orders_delta(old, new):
+    """比較兩份訂單二維陣列，回傳 (事件種類, 新增列)。"""
+    if old and new and len(new) >= len(old) and new[:len(old)] == old:
+        return "append", new[len(old):]
+    return "replace", []
+
+# 取得訂單推播頻道；背景執行緒在有人檢視時依 ORDER_POLL_INTERVAL 向 Sheet 確認外部修改 (全程序共用一次讀取)
+@st.cache_resource
+def get_order_broadcast(_backend, sheet_url):
+    cache = get_shared_cache(_backend, sheet_url)
+    broadcast = OrderBroadcast()
+    def on_change(key, old, new, version):
+        if key == "orders": broadcast.publish(*orders_delta(old, new))
+    cache.subscribe(on_change)
+
+    def poll():
+        while True:
+            time.sleep(ORDER_LIVE_REFRESH)
+            if not broadcast.watched(): continue
+            try: cache.refresh_if_stale("orders")
+            except Exception as e: print(f"Order Poll Error: {e}")
+    threading.Thread(target=poll, name="order-poll", daemon=True).start()
+    return broadcast
+
+# 讀取本次執行的設定資料快照
+def load_data_snapshot(cache):
+    keys = ["menu", "toppings"]
+    vals = cache.get(keys)
+    menus, err = vals["menu"]
+    return DataSnapshot(
+        menus=menus,
+        menu_error=err,
+        toppings=vals["toppings"],
+        versions={k: cache.version(k) for k in keys},
+    )
 
 # ==========================================
-# 2. 資料讀取層 (Data Access Layer)
+# 3. 功能操作層 (Actions Layer)
 # ==========================================
 
-# 讀取菜單 (快取 60s)
-@st.cache_data(ttl=60)
-def load_menu_from_sheet(_client, sheet_url):
-    try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        try:
-            worksheet = spreadsheet.worksheet("菜單設定")
-        except gspread.WorksheetNotFound:
-            return None, "找不到「菜單設定」分頁"
-        
-        rows = worksheet.get_all_values()
-        if len(rows) < 2: return None, "無資料"
-        
-        headers = [h.strip() for h in rows[0]]
-        
-        # 欄位對應
-        def find_idx(candidates):
-            for c in candidates:
-                if c in headers: return headers.index(c)
-            return -1
-            
-        idx_store = find_idx(["店家", "Store"])
-        idx_item = find_idx(["品項", "Item", "飲料"])
-        idx_m = find_idx(["中杯", "M", "m", "中"])
-        idx_l = find_idx(["大杯", "L", "l", "大"])
-        idx_p = find_idx(["價格", "Price", "單一規格"])
-        
-        if idx_store == -1 or idx_item == -1: return None, "欄位對應失敗"
+# 價格索引：由菜單 / 加料預先編譯的查價表
+# (店家, 品項, 大小) 與 (店家, 加料) 皆為 O(1) 查詢，並提供整個 DataFrame 的向量化重算。
+class PriceIndex:
+    def __init__(self, menus, toppings):
+        self.base = {}
+        self.single = {}   # 大小對不到時的備用價格 (單一規格)
+        for store, items in (menus or {}).items():
+            for item, sizes in items.items():
+                for size, price in sizes.items():
+                    self.base[(store, item, size)] = int(price)
+                self.single[(store, item)] = int(sizes.get("單一規格", 0))
+        self.tops = {(store, name): int(price)
+                     for store, tops in (toppings or {}).items() for name, price in tops.items()}
+        self._top_memo = {}
 
-        menus = {}
-        for row in rows[1:]:
-            if len(row) <= max(idx_store, idx_item): continue
-            store, item = row[idx_store].strip(), row[idx_item].strip()
-            if not store or not item: continue
-            
-            prices = {}
-            def clean_p(val):
-                v = str(val).replace("$", "").replace(",", "").strip()
-                return int(v) if v.isdigit() else None
-
-            pm, pl, pp = None, None, None
-            if idx_m != -1 and idx_m < len(row): pm = clean_p(row[idx_m])
-            if idx_l != -1 and idx_l < len(row): pl = clean_p(row[idx_l])
-            if idx_p != -1 and idx_p < len(row): pp = clean_p(row[idx_p])
-            
-            if pm: prices["中杯"] = pm
-            if pl: prices["大杯"] = pl
-            if not prices: prices["單一規格"] = pp if pp else 0
-            
-            if store not in menus: menus[store] = {}
-            menus[store][item] = prices
-            
-        return menus, None
-    except Exception as e:
-        return None, str(e)
+    def base_price(self, store, item, size):
+        p = self.base.get((store, item, size))
+        return p if p is not None else self.single.get((store, item), 0)
 
-# 讀取加料 (快取 60s)
-@st.cache_data(ttl=60)
-def load_toppings_from_sheet(_client, sheet_url):
-    try:
-        sh = _client.open_by_url(sheet_url)
-        ws = sh.worksheet("加料設定")
-        rows = ws.get_all_values()
-        if len(rows) < 2: return {}
-        
-        headers = [h.strip() for h in rows[0]]
-        idx_store = headers.index("店家") if "店家" in headers else -1
-        idx_name = headers.index("加料品項") if "加料品項" in headers else headers.index("品項")
-        idx_price = headers.index("價格") if "價格" in headers else -1
-        
-        if idx_store == -1 or idx_name == -1 or idx_price == -1: return {}
-        
-        toppings = {}
-        for row in rows[1:]:
-            if len(row) <= max(idx_store, idx_name, idx_price): continue
-            store, name = row[idx_store].strip(), row[idx_name].strip()
-            price = str(row[idx_price]).replace("$", "").strip()
-            if store and name and price.isdigit():
-                if store not in toppings: toppings[store] = {}
-                toppings[store][name] = int(price)
-        return toppings
-    except:
-        return {}
+    def topping_price(self, store, toppings):
+        """toppings 可為加料名稱的 list，或訂單上以逗號分隔的字串。"""
+        if isinstance(toppings, str):
+            key = (store, toppings)
+            if key not in self._top_memo:
+                names = [t.strip() for t in toppings.split(",")]
+                self._top_memo[key] = sum(self.tops.get((store, t), 0) for t in names if t)
+            return self._top_memo[key]
+        return sum(self.tops.get((store, t), 0) for t in toppings)
 
-# 讀取存款 (快取 60s)
-@st.cache_data(ttl=60)
-def load_balances_from_sheet(_client, sheet_url):
-    try:
-        sh = _client.open_by_url(sheet_url)
-        ws = sh.worksheet("會員儲值")
-        rows = ws.get_all_values()
-        if len(rows) < 2: return {}
-        
-        headers = [h.strip() for h in rows[0]]
-        idx_name = -1
-        for k in ["姓名", "Name", "員工", "員工姓名"]:
-            if k in headers: 
-                idx_name = headers.index(k)
-                break
+    def price(self, store, item, size, toppings=()):
+        return self.base_price(store, item, size) + self.topping_price(store, toppings)
+
+    def price_orders(self, df):
+        """
+        向量化重算整個訂單 DataFrame 的價格 (飲料 + 加料)，回傳與 df 同 index 的 int Series。
+        對不到菜單的列回傳 0，由呼叫端決定是否保留原價。
+        """
+        if df.empty or not {"店家", "品項", "大小"}.issubset(df.columns):
+            return pd.Series(0, index=df.index, dtype="int64")
         
-        idx_bal = -1
-        for k in ["存款餘額", "餘額", "存款", "Balance", "金額", "目前餘額"]:
-            if k in headers:
-                idx_bal = headers.index(k)
-                break
-                
-        if idx_name == -1 or idx_bal == -1: return {}
+        stores = df["店家"].astype(str)
+        keys = pd.MultiIndex.from_arrays([stores, df["品項"].astype(str), df["大小"].astype(str)])
+        base_s = pd.Series(self.base, dtype="int64")
+        single_s = pd.Series(self.single, dtype="int64")
+        base = pd.Series(base_s.reindex(keys).to_numpy(), index=df.index) if len(base_s) else pd.Series(float("nan"), index=df.index)
+        fallback = (pd.Series(single_s.reindex(keys.droplevel(2)).to_numpy(), index=df.index)
+                    if len(single_s) else pd.Series(0, index=df.index))
+        base = base.fillna(fallback).fillna(0)
         
-        balances = {}
-        for row in rows[1:]:
-            if len(row) <= max(idx_name, idx_bal): continue
-            name = str(row[idx_name]).strip()
-            bal = str(row[idx_bal]).replace("$", "").replace(",", "").strip()
-            if name:
-                try: balances[name] = int(float(bal))
-                except: balances[name] = 0
-        return balances
-    except:
-        return {}
-
-# 讀取訂單 (快取 5s - 高頻率)
-@st.cache_data(ttl=5)
-def get_orders_from_sheet(_client, sheet_url):
-    try:
-        sh = _client.open_by_url(sheet_url)
-        ws = sh.get_worksheet(0)
-        return ws.get_all_values()
-    except:
-        return []
+        # 加料組合通常很少：只對不重複的 (店家, 加料字串) 計算一次
+        if "加料" in df.columns:
+            tops = df["加料"].fillna("").astype(str)
+            combos = pd.MultiIndex.from_arrays([stores, tops])
+            cost = {c: self.topping_price(c[0], c[1]) for c in combos.unique()}
+            top_cost = pd.Series(pd.Series(cost, dtype="int64").reindex(combos).to_numpy(), index=df.index)
+        else:
+            top_cost = 0
+        return (base + top_cost).astype("int64")
 
-# ==========================================
-# 3. 功能操作層 (Actions Layer)
-# ==========================================
+# 依版本建立的共用物件：每個群組各自保留最新版本的一份，群組再多也不會互相擠出快取
+class VersionedValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._value = None
+
+    def get(self, version, build):
+        """version 與上次相同時回傳同一個物件；否則以 build() 重建 (同一時間只建立一次)。"""
+        with self._lock:
+            if self._version != version:
+                self._value = build()
+                self._version = version
+            return self._value
+
+@st.cache_resource
+def get_versioned(sheet_url, name):
+    return VersionedValue()
+
+# 取得價格索引 (只在菜單或加料的快取版本改變時重建)
+def get_price_index(sheet_url, menu_version, topping_version, menus, toppings):
+    return get_versioned(sheet_url, "price_index").get((menu_version, topping_version),
+                                                        lambda: PriceIndex(menus, toppings))
+
+# 訂單 DataFrame：同一個訂單版本只建立一次，管理員專區、訂單列表與結算共用同一個物件 (呼叫端不可修改)
+def get_orders_frame(sheet_url, orders_version, grid):
+    return get_versioned(sheet_url, "orders_frame").get(orders_version, lambda: orders_frame(grid))
+
+def read_orders(cache, live=False):
+    """回傳 (訂單版本, 訂單二維陣列)，兩者在同一次加鎖中取得，版本一定對應到這份資料。
+    live 時只讀記憶體中的共用狀態 (由推播頻道的背景輪詢保持新鮮)；否則先經過 value() 讓過期資料在背景重新讀取。
+    快取尚未讀取過時才同步讀取 Sheet。"""
+    if live:
+        current = cache.current("orders")
+        if current: return current
+    grid = cache.value("orders")
+    current = cache.current("orders")
+    # 冷快取讀取失敗時 value() 回傳的替代值不會寫入快取，以版本 0 代表
+    return current if current else (0, grid)
+
+def load_orders_frame(cache, sheet_url, live=False):
+    """回傳 (訂單二維陣列, 訂單 DataFrame 或 None)。"""
+    version, grid = read_orders(cache, live)
+    return grid, get_orders_frame(sheet_url, version, grid)
+
+# 叫貨統計：依 (店家, 品項, 大小, 甜度, 冰塊, 加料) 累計杯數與金額，給打電話訂飲料的人直接照唸。
+# 訂單只在尾端新增時只累加新列；標題改變、刪列、修改或清空時整份重算。
+TALLY_KEYS = ['店家', '品項', '大小', '甜度', '冰塊', '加料']
+
+class OrderTally:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.updated = None
+        self._reset([])
 
-# 取得 Drive Service (重構以共用)
-def get_drive_service(s_info):
+    def _reset(self, header):
+        header = [str(h).strip() for h in header]
+        self._header = header
+        self._rows = []
+        self._groups = {}    # key -> {"杯數", "金額", "備註": [...]}
+        self._cols = {c: header.index(c) if c in header else -1 for c in TALLY_KEYS + ['價格', '姓名', '備註']}
+
+    def _cell(self, row, col):
+        i = self._cols[col]
+        return str(row[i]).strip() if 0 <= i < len(row) else ""
+
+    def _add(self, rows):
+        for row in rows:
+            key = tuple(self._cell(row, c) for c in TALLY_KEYS)
+            if not key[0] or not key[1]: continue
+            # 加料順序不同視為同一種
+            key = key[:-1] + (", ".join(sorted(t.strip() for t in key[-1].split(",") if t.strip())),)
+            g = self._groups.setdefault(key, {"杯數": 0, "金額": 0, "備註": []})
+            g["杯數"] += 1
+            try: g["金額"] += parse_price(self._cell(row, '價格')) or 0
+            except ValueError: pass
+            note = self._cell(row, '備註')
+            if note: g["備註"].append(f"{self._cell(row, '姓名')}：{note}")
+        self._rows.extend(rows)
+
+    def sync(self, grid, version=None):
+        """把訂單二維陣列 (含標題列) 併入統計；version 與上次相同時直接略過。"""
+        with self._lock:
+            if version is not None and version == self.version: return
+            header, body = (grid[0], grid[1:]) if grid else ([], [])
+            n = len(self._rows)
+            if [str(h).strip() for h in header] == self._header and len(body) >= n and body[:n] == self._rows:
+                self._add(body[n:])
+            else:
+                self._reset(header)
+                self._add(body)
+            self.version = version
+            self.updated = datetime.now()
+
+    def rows(self, store=None):
+        """依店家 / 品項 / 大小 / 甜度 / 冰塊 / 加料排序的統計列 (dict)。"""
+        with self._lock:
+            items = sorted(self._groups.items())
+        return [{**dict(zip(TALLY_KEYS, k)), "杯數": g["杯數"], "金額": g["金額"], "備註": "；".join(g["備註"])}
+                for k, g in items if store is None or k[0] == store]
+
+    def stores(self):
+        """{店家: (杯數, 金額)}，依店家名稱排序。"""
+        out = {}
+        with self._lock:
+            for k, g in sorted(self._groups.items()):
+                cups, amount = out.get(k[0], (0, 0))
+                out[k[0]] = (cups + g["杯數"], amount + g["金額"])
+        return out
+
+@st.cache_resource
+def get_order_tally(sheet_url):
+    return OrderTally()
+
+def load_order_tally(cache, sheet_url, live=False):
+    version, grid = read_orders(cache, live)
+    tally = get_order_tally(sheet_url)
+    tally.sync(grid, version)
+    return tally
+
+# 結算預覽表：每人今日消費 join 目前存款，計算扣款後餘額與狀態 (全部以欄位運算完成)
+def build_settlement_frame(df, balances):
+    cols = ["姓名", "目前存款", "今日消費", "扣款後餘額", "狀態"]
+    if df.empty: return pd.DataFrame(columns=cols)
+    
+    spending = df["價格"].groupby(df["姓名"]).sum()
+    out = spending.rename("今日消費").to_frame()
+    out["目前存款"] = pd.Series(balances or {}, dtype="int64").reindex(out.index).fillna(0).astype("int64")
+    out["今日消費"] = out["今日消費"].astype("int64")
+    out["扣款後餘額"] = out["目前存款"] - out["今日消費"]
+    out["狀態"] = "❌ 不足"
+    out.loc[out["扣款後餘額"] >= 0, "狀態"] = "✅ 足夠"
+    return out.rename_axis("姓名").reset_index()[cols]
+
+# 由 (可能經管理員修改的) 結算表產生餘額更新與交易紀錄
+def settlement_changes(bal_df):
+    new = pd.to_numeric(bal_df["扣款後餘額"], errors="coerce").fillna(0).astype("int64")
+    cur = pd.to_numeric(bal_df["目前存款"], errors="coerce").fillna(0).astype("int64")
+    update_map = dict(zip(bal_df["姓名"].tolist(), new.tolist()))
+    
+    changed = new != cur
+    logs = pd.DataFrame({
+        "name": bal_df["姓名"],
+        "change": new - cur,
+        "bal": new,
+        "note": "消費 " + pd.to_numeric(bal_df["今日消費"], errors="coerce").fillna(0).astype("int64").astype(str),
+    })[changed]
+    # 預覽時看到的餘額，寫入前用來偵測其他人的修改
+    expected = dict(zip(bal_df["姓名"].tolist(), cur.tolist()))
+    return update_map, logs.to_dict("records"), expected
+
+# 取得 Drive Service：與 gspread 共用同一組憑證 (同一個 access token)，discovery client 全程序只建立一次
+@st.cache_resource
+def _drive_service(client_email, _creds):
+    return instrument_drive(build('drive', 'v3', credentials=_creds, cache_discovery=False), get_api_metrics(),
+                            get_rate_limiter())
+
+def get_drive_service(client):
+    # 建立失敗時不快取 (例外不會被 cache_resource 記住)，下次再試
     try:
-        private_key = s_info["private_key"].replace("\\n", "\n")
-        creds_dict = {
-            "type": s_info["type"],
-            "project_id": s_info["project_id"],
-            "private_key_id": s_info["private_key_id"],
-            "private_key": private_key,
-            "client_email": s_info["client_email"],
-            "client_id": s_info["client_id"],
-            "auth_uri": s_info.get("auth_uri", "https://accounts.google.com/o/oauth2/auth"),
-            "token_uri": s_info.get("token_uri", "https://oauth2.googleapis.com/token"),
-            "auth_provider_x509_cert_url": s_info.get("auth_provider_x509_cert_url", "https://www.googleapis.com/oauth2/v1/certs"),
-            "client_x509_cert_url": s_info["client_x509_cert_url"]
-        }
-        scopes = ['https://www.googleapis.com/auth/drive']
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        creds = client.http_client.auth
+        return _drive_service(creds.service_account_email, creds)
     except Exception as e:
         print(f"Drive Service Error: {e}")
         return None
@@ -287,30 +2323,188 @@ def get_folder_id(s_info):
         except: pass
     return folder_id
 
-# 寫入交易紀錄
-def log_transaction(_client, sheet_url, name, amount_change, new_balance, note=""):
-    try:
-        sh = _client.open_by_url(sheet_url)
+# 訂單寫入佇列 (Write-behind)
+# 送出訂單時先寫入本機暫存檔並立即回應，由背景執行緒把累積的訂單合併成一次 append_rows 寫入 Sheet。
+class OrderQueue:
+    def __init__(self, backend, spool_path=ORDER_SPOOL_PATH, on_flush=None, limiter=None, on_change=None):
+        self.backend = backend
+        self.limiter = limiter
+        self.spool_path = spool_path
+        self.on_flush = on_flush
+        self.on_change = on_change   # 佇列內容或狀態改變 (新訂單、寫入失敗) 時呼叫
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = self._load_spool()
+        self._attempts = 0
+        self._next_try = 0.0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="order-flusher", daemon=True)
+        self._thread.start()
+
+    # --- 暫存檔 ---
+    def _load_spool(self):
+        pending = []
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line: continue
+                    try: pending.append(json.loads(line))
+                    except ValueError: continue  # 寫到一半的殘缺行
+        return pending
+
+    def _rewrite_spool(self):
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.spool_path)
+
+    # --- 對外介面 ---
+    def submit(self, row):
+        entry = {"id": uuid.uuid4().hex, "row": list(row), "status": "pending"}
+        with self._lock:
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending.append(entry)
+            # 有新訂單時，讓先前重試失敗的訂單一起再試一次
+            for e in self._pending:
+                e["status"] = "pending"
+        self._wakeup.set()
+        self._notify([entry["row"]])
+        return entry["id"]
+
+    def _notify(self, rows=()):
+        if self.on_change:
+            try: self.on_change(rows)
+            except Exception: pass
+
+    def pending(self):
+        with self._lock:
+            return [dict(e) for e in self._pending]
+
+    def flush(self):
+        """立即寫入所有暫存訂單 (同步)，成功回傳 True。"""
+        with self._lock:
+            for e in self._pending:
+                e["status"] = "pending"
+            self._next_try = 0.0
+        return self._flush_once()
+
+    # --- 背景寫入 ---
+    def _run(self):
+        while True:
+            if self._wakeup.wait(ORDER_FLUSH_INTERVAL):
+                # 等待一小段時間，把同時送出的訂單合併成一批
+                time.sleep(ORDER_FLUSH_INTERVAL)
+                self._wakeup.clear()
+            if time.time() < self._next_try: continue
+            try:
+                self._flush_once()
+            except Exception as e:
+                print(f"Order Flush Error: {e}")
+
+    def _flush_once(self):
+        # 同一時間只允許一批寫入，避免背景執行緒與手動 flush 重複寫入
+        with self._flush_lock:
+            return self._write_batch()
+
+    def _write_batch(self):
+        with self._lock:
+            batch = [e for e in self._pending if e["status"] == "pending"]
+        if not batch: return True
+
         try:
-            ws_log = sh.worksheet("交易紀錄")
-        except:
-            ws_log = sh.add_worksheet(title="交易紀錄", rows=1000, cols=5)
-            ws_log.append_row(["時間", "姓名", "變動金額", "變動後餘額", "備註"])
-        
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ws_log.append_row([ts, name, amount_change, new_balance, note])
+            # 使用者送出的訂單優先取得寫入額度
+            with self.limiter.priority(PRIORITY_ORDER) if self.limiter else nullcontext():
+                self.backend.append_orders([e["row"] for e in batch])
+        except Exception as e:
+            with self._lock:
+                self.last_error = str(e)
+                self._attempts += 1
+                # 等不到額度、配額 (429，HTTP 層重試用盡) 或伺服器錯誤：確定沒有寫入，以退避時間在背景重排；
+                # 其他錯誤無法確定是否已寫入，標記失敗，由管理員確認 Sheet 後手動重試，避免重複寫入
+                if isinstance(e, RateLimitTimeout) or classify_api_error(e) in ("quota", "server"):
+                    self._next_try = time.time() + backoff_delay(self._attempts - 1, ORDER_RETRY_BASE, ORDER_RETRY_MAX)
+                else:
+                    for b in batch: b["status"] = "failed"
+                    self._attempts = 0
+                    self._next_try = 0.0
+                self._rewrite_spool()
+                failed = batch[0]["status"] == "failed"
+            if failed: self._notify()
+            return False
+
+        done = {e["id"] for e in batch}
+        with self._lock:
+            self._pending = [e for e in self._pending if e["id"] not in done]
+            self._attempts = 0
+            self._next_try = 0.0
+            self.last_error = None
+            self._rewrite_spool()
+        if self.on_flush:
+            try: self.on_flush([e["row"] for e in batch])
+            except Exception: pass
         return True
-    except Exception as e:
-        print(f"Log Error: {e}")
-        return False
+
+# 取得訂單寫入佇列 (全程序共用一個背景寫入執行緒)
+@st.cache_resource
+def get_order_queue(_backend, sheet_url, spool_path=ORDER_SPOOL_PATH):
+    cache = get_shared_cache(_backend, sheet_url)
+    broadcast = get_order_broadcast(_backend, sheet_url)
+    def on_flush(rows):
+        # 直接把剛寫入的訂單接到快取的尾端 (快取改變時即推播)，再於背景向 Sheet 確認
+        grid = cache.peek("orders")
+        if grid: cache.put("orders", grid + [[str(v) for v in r] for r in rows])
+        else:
+            broadcast.publish("pending")
+            cache.invalidate("orders")
+    return OrderQueue(_backend, spool_path, on_flush=on_flush, limiter=get_rate_limiter(),
+                      on_change=lambda rows: broadcast.publish("pending", rows))
 
 # 產生 PDF
-def generate_pdf_report(df, total_amount):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
+PDF_COLUMNS = ['時間', '姓名', '品項', '大小', '加料', '甜度', '冰塊', '價格', '備註']
+
+def _pdf_table_style(font_name, header_rows=1):
+    return TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), font_name),
+        ('BACKGROUND', (0, 0), (-1, header_rows - 1), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, header_rows - 1), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
+        ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ])
+
+def iter_report_rows(df, cols, chunk_rows=PDF_TABLE_CHUNK):
+    """逐段把訂單轉成字串列，避免一次轉換整張 DataFrame。"""
+    for start in range(0, len(df), chunk_rows):
+        part = df.iloc[start:start + chunk_rows][cols]
+        yield from part.astype(object).where(part.notna(), "").astype(str).values.tolist()
+
+def report_summary(df):
+    """依店家 / 人員彙總杯數與金額，回傳 {標題: [表頭] + 資料列}。"""
+    price = pd.to_numeric(df['價格'], errors='coerce').fillna(0).astype(int) if '價格' in df.columns else None
+    sections = {}
+    for key, title in (('店家', '店家小計'), ('姓名', '人員小計')):
+        if key not in df.columns or price is None: continue
+        g = price.groupby(df[key].astype(str)).agg(['count', 'sum']).sort_values('sum', ascending=False)
+        sections[title] = [[key, '杯數', '金額']] + [[k, int(c), int(s)] for k, (c, s) in g.iterrows()]
+    return sections
+
+def generate_pdf_report(df, total_amount, font_name=None, summary=False, chunk_rows=PDF_TABLE_CHUNK):
+    """產生結算單 PDF，寫入 SpooledTemporaryFile (過大時自動落地到暫存檔)，回傳已 seek(0) 的檔案物件。"""
+    out = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX)
+    doc = SimpleDocTemplate(out, pagesize=A4)
     elements = []
     
-    font_name = setup_chinese_font() or 'Helvetica'
+    font_name = font_name or get_font_provider().font_name()
     styles = getSampleStyleSheet()
     title_style = ParagraphStyle('Title', parent=styles['Title'], fontName=font_name, fontSize=20, leading=24)
     normal_style = ParagraphStyle('Normal', parent=styles['Normal'], fontName=font_name, fontSize=12, leading=16)
@@ -318,186 +2512,600 @@ def generate_pdf_report(df, total_amount):
     today = datetime.now().strftime("%Y-%m-%d")
     elements.append(Paragraph(f"飲料訂購結算單 ({today})", title_style))
     elements.append(Spacer(1, 12))
-    elements.append(Paragraph(f"今日總營業額：{total_amount} 元", normal_style))
+    elements.append(Paragraph(f"今日總營業額：{total_amount} 元 (共 {len(df)} 筆)", normal_style))
     elements.append(Spacer(1, 12))
     
-    cols_to_show = ['時間', '姓名', '品項', '大小', '加料', '甜度', '冰塊', '價格', '備註']
-    final_cols = [c for c in cols_to_show if c in df.columns]
-    
-    # 準備表格資料
-    data = [final_cols] + df[final_cols].astype(str).values.tolist()
-    
-    t = Table(data)
-    t.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), font_name),
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
-        ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-    ]))
+    # 彙總表 (選用)：放在明細之前，方便對帳
+    if summary:
+        for title, data in report_summary(df).items():
+            elements.append(Paragraph(title, normal_style))
+            elements.append(Spacer(1, 6))
+            elements.append(Table(data, repeatRows=1, style=_pdf_table_style(font_name)))
+            elements.append(Spacer(1, 12))
+        elements.append(PageBreak())
     
-    elements.append(t)
+    # 明細為單一表格，由 reportlab 依版面剩餘空間分頁，repeatRows 讓每一頁都重複表頭
+    final_cols = [c for c in PDF_COLUMNS if c in df.columns]
+    elements.append(Table([final_cols] + list(iter_report_rows(df, final_cols, chunk_rows)),
+                          repeatRows=1, style=_pdf_table_style(font_name)))
     doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    out.seek(0)
+    return out
 
-# 上傳 Google Drive
-def upload_to_drive(pdf_bytes, filename, s_info):
-    try:
-        folder_id = get_folder_id(s_info)
-        if not folder_id:
-            st.error("❌ 上傳失敗：找不到 `drive_folder_id`。請確認 Secrets 設定位置。")
-            return None
+# 叫貨單：純文字 (可直接貼到通訊軟體) 與單頁 PDF
+def tally_text(rows, title):
+    lines, store = [title], None
+    for r in rows:
+        if r["店家"] != store:
+            store = r["店家"]
+            cups = sum(x["杯數"] for x in rows if x["店家"] == store)
+            lines += ["", f"【{store}】共 {cups} 杯"]
+        spec = " ".join(v for v in (r["品項"], r["大小"], r["甜度"], r["冰塊"]) if v)
+        lines.append(f"{spec}{' +' + r['加料'] if r['加料'] else ''} × {r['杯數']}")
+        if r["備註"]: lines.append(f"    備註：{r['備註']}")
+    return "\n".join(lines) + "\n"
 
-        service = get_drive_service(s_info)
-        if not service:
-            st.error("❌ Google Drive 認證失敗")
-            return None
-        
-        # 3. 上傳
+def generate_tally_pdf(rows, title, font_name):
+    """單頁叫貨單 PDF (bytes)：依列數縮小字級，約 80 種組合內可放進一頁 A4。"""
+    out = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX)
+    doc = SimpleDocTemplate(out, pagesize=A4, topMargin=36, bottomMargin=36, leftMargin=36, rightMargin=36)
+    cols = ["店家", "品項", "大小", "甜度", "冰塊", "加料", "杯數", "備註"]
+    size = max(5, min(11, ((A4[1] - 72 - 60) / (len(rows) + 1) - 2) / 1.2))
+    cell_style = ParagraphStyle('TallyCell', fontName=font_name, fontSize=size, leading=size * 1.2)
+    title_style = ParagraphStyle('TallyTitle', fontName=font_name, fontSize=16, leading=20)
+    
+    data = [cols] + [[r[c] if c != "備註" else Paragraph(r[c], cell_style) for c in cols] for r in rows]
+    widths = [None] * (len(cols) - 1) + [A4[0] * 0.3]
+    style = _pdf_table_style(font_name)
+    for cmd in (('FONTSIZE', (0, 0), (-1, -1), size), ('LEADING', (0, 0), (-1, -1), size * 1.2),
+                ('TOPPADDING', (0, 0), (-1, -1), 1), ('BOTTOMPADDING', (0, 0), (-1, -1), 1),
+                ('ALIGN', (-1, 1), (-1, -1), 'LEFT')):
+        style.add(*cmd)
+    doc.build([Paragraph(title, title_style), Spacer(1, 8), Table(data, colWidths=widths, repeatRows=1, style=style)])
+    out.seek(0)
+    return out.read()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def tally_pdf(sheet_url, version, store, font_name, _rows, title):
+    return generate_tally_pdf(_rows, title, font_name)
+
+# 上傳 Google Drive：回傳 (連結, 訊息等級, 訊息)，可在背景執行緒呼叫 (不直接操作 st 元件)
+def upload_to_drive(pdf_file, filename, service, folder_id):
+    if not folder_id:
+        return None, "error", "❌ 上傳失敗：找不到 `drive_folder_id`。請確認 Secrets 設定位置。"
+    if not service:
+        return None, "error", "❌ Google Drive 認證失敗"
+    try:
         file_metadata = {'name': filename, 'parents': [folder_id]}
-        media = MediaIoBaseUpload(pdf_bytes, mimetype='application/pdf', resumable=True)
+        media = MediaIoBaseUpload(pdf_file, mimetype='application/pdf', resumable=True)
         file = service.files().create(
             body=file_metadata, 
             media_body=media, 
             fields='id, webViewLink',
             supportsAllDrives=True
         ).execute()
-        return file.get('webViewLink')
+        return file.get('webViewLink'), "success", "📂 PDF 已上傳至雲端"
         
     except Exception as e:
         error_str = str(e)
         if "storageQuotaExceeded" in error_str:
-            # 這是最關鍵的修改：遇到空間不足，不報 Error，改報 Warning 並回傳 None
-            st.warning("⚠️ **上傳略過：機器人帳號無儲存空間** (Google 限制：Service Account 上傳的檔案會佔用機器人自己的額度)。\n程式將繼續執行結算，請使用下方的按鈕下載 PDF。")
-            return None
+            # 遇到空間不足，不報 Error，改報 Warning
+            return None, "warning", "⚠️ **上傳略過：機器人帳號無儲存空間** (Google 限制：Service Account 上傳的檔案會佔用機器人自己的額度)。\n請使用下方的按鈕下載 PDF。"
         elif "File not found" in error_str:
-            st.error(f"❌ 上傳失敗：找不到資料夾 ID `{folder_id}`。請確認 ID 正確且機器人有權限。")
-        else:
-            st.error(f"上傳 Google Drive 失敗: {e}")
-        return None
+            return None, "error", f"❌ 上傳失敗：找不到資料夾 ID `{folder_id}`。請確認 ID 正確且機器人有權限。"
+        return None, "error", f"上傳 Google Drive 失敗: {e}"
+
+# 背景報表工作：結算只送出工作並取得 job id，不必等 PDF 產生與上傳
+REPORT_STATUS = {"queued": "⏳ 排隊中", "rendering": "🖨️ 產生 PDF 中", "uploading": "☁️ 上傳中",
+                 "done": "✅ 完成", "failed": "❌ 失敗"}
+
+class ReportJobs:
+    """以執行緒池執行「產生 PDF → 上傳 Drive」，並保留最近幾筆工作的狀態與 PDF 供下載。
+
+    預設只用一個 worker：同一時間只有一份報表在產生，Drive service (httplib2) 也不會被多執行緒共用。
+    """
+
+    def __init__(self, workers=REPORT_WORKERS, keep=REPORT_JOB_KEEP):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, df, total_amount, filename, font=None, summary=False, service=None, folder_id=None):
+        job_id = uuid.uuid4().hex[:8]
+        job = {"id": job_id, "filename": filename, "status": "queued", "created": time.time(), "finished": None,
+               "link": None, "level": None, "message": "", "pdf": None}
+        with self._lock:
+            self._jobs[job_id] = job
+            self._trim()
+        # 複製一份 DataFrame，結算後的訂單清空不會影響報表內容
+        self._pool.submit(self._run, job, df.copy(), total_amount, font, summary, service, folder_id)
+        return job_id
+
+    def _set(self, job, **kw):
+        with self._lock: job.update(kw)
+
+    def _run(self, job, df, total_amount, font, summary, service, folder_id):
+        try:
+            self._set(job, status="rendering")
+            font_name = font.font_name() if font else None
+            pdf = generate_pdf_report(df, total_amount, font_name, summary=summary)
+            self._set(job, status="uploading", pdf=pdf)
+            link, level, message = upload_to_drive(pdf, job["filename"], service, folder_id)
+            self._set(job, status="done", link=link, level=level, message=message)
+        except Exception as e:
+            self._set(job, status="failed", level="error", message=f"報表產生失敗: {e}")
+        finally:
+            self._set(job, finished=time.time())
+
+    def _trim(self):
+        finished = [j for j in self._jobs.values() if j["finished"]]
+        for j in finished[:max(0, len(self._jobs) - self.keep)]:
+            if j["pdf"]: j["pdf"].close()
+            del self._jobs[j["id"]]
+
+    def get(self, job_id):
+        """工作狀態 (不含 PDF 檔案物件)；找不到回傳 None。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {k: v for k, v in job.items() if k != "pdf"} if job else None
+
+    def pdf_bytes(self, job_id):
+        """工作完成後取得 PDF 內容；尚未完成或已被清除時回傳 None。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or not job["finished"] or not job["pdf"]: return None
+            job["pdf"].seek(0)
+            return job["pdf"].read()
+
+    def recent(self):
+        with self._lock:
+            return [{k: v for k, v in j.items() if k != "pdf"} for j in reversed(list(self._jobs.values()))]
+
+@st.cache_resource
+def get_report_jobs():
+    return ReportJobs()
+
+# 結算預寫日誌 (Write-ahead journal)
+# 執行前先記錄結算 id、每人目標餘額與變動、交易紀錄、要清除的訂單，再逐步執行並記錄完成的步驟。
+# 中途失敗或程序重啟後可從未完成的步驟繼續，不會重複扣款。
+# 訂單歷史：結算時把當次訂單封存到本機 SQLite，供日後以日期 / 人員 / 店家查詢統計。
+# 以 (日期)、(姓名, 日期)、(店家, 日期) 建索引，查詢只讀取符合條件的列並在資料庫內彙總。
+ORDER_ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (seq INTEGER PRIMARY KEY AUTOINCREMENT, settlement TEXT NOT NULL,
+                                   day TEXT NOT NULL, ts TEXT, store TEXT, name TEXT, item TEXT, size TEXT,
+                                   toppings TEXT, price INTEGER NOT NULL DEFAULT 0, sugar TEXT, ice TEXT, note TEXT);
+CREATE INDEX IF NOT EXISTS idx_orders_day ON orders (day);
+CREATE INDEX IF NOT EXISTS idx_orders_name ON orders (name, day);
+CREATE INDEX IF NOT EXISTS idx_orders_store ON orders (store, day);
+CREATE INDEX IF NOT EXISTS idx_orders_settlement ON orders (settlement);
+"""
+ARCHIVE_COLUMNS = {"時間": "ts", "店家": "store", "姓名": "name", "品項": "item", "大小": "size",
+                   "加料": "toppings", "價格": "price", "甜度": "sugar", "冰塊": "ice", "備註": "note"}
+# 可分組的維度 -> SQL 運算式 (只接受這些鍵，不會把使用者輸入拼進 SQL)
+ARCHIVE_DIMENSIONS = {"日期": "day", "月份": "substr(day, 1, 7)", "店家": "store", "姓名": "name",
+                      "品項": "item", "大小": "size", "甜度": "sugar", "冰塊": "ice"}
+
+class OrderArchive:
+    def __init__(self, path=ORDER_ARCHIVE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(ORDER_ARCHIVE_SCHEMA)
+
+    def add_settlement(self, settlement_id, grid, day):
+        """
+        封存一次結算的訂單 (含標題列的二維陣列)；同一個結算只會寫入一次，重試時直接略過。
+        時間無法解析的訂單以結算日期 day (YYYY-MM-DD) 歸檔。回傳寫入筆數。
+        """
+        df = orders_frame(grid)
+        if df is None or df.empty: return 0
+        cols = [c for c in ARCHIVE_COLUMNS if c in df.columns]
+        days = df["時間"].dt.strftime("%Y-%m-%d").fillna(day) if "時間" in df.columns else pd.Series(day, index=df.index)
+        out = df[cols].astype(object).where(df[cols].notna(), "")
+        if "時間" in out.columns: out["時間"] = df["時間"].dt.strftime(ORDER_TIME_FORMAT).fillna("")
+        if "價格" in out.columns: out["價格"] = df["價格"].astype(int)
+        sql = (f"INSERT INTO orders (settlement, day, {', '.join(ARCHIVE_COLUMNS[c] for c in cols)}) "
+               f"VALUES (?, ?{', ?' * len(cols)})")
+        rows = [(settlement_id, d, *r) for d, r in zip(days, out.itertuples(index=False, name=None))]
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM orders WHERE settlement = ? LIMIT 1", (settlement_id,)).fetchone():
+                return 0
+            self._conn.executemany(sql, rows)
+        return len(rows)
+
+    def summary(self):
+        """{"orders": 總筆數, "first": 最早日期, "last": 最晚日期}"""
+        with self._lock:
+            n, first, last = self._conn.execute("SELECT COUNT(*), MIN(day), MAX(day) FROM orders").fetchone()
+        return {"orders": n, "first": first, "last": last}
+
+    def distinct(self, dimension, start=None, end=None):
+        """某個維度在日期區間內出現過的值 (供篩選選單使用)。"""
+        expr = ARCHIVE_DIMENSIONS[dimension]
+        with self._lock:
+            rows = self._conn.execute(f"SELECT DISTINCT {expr} FROM orders WHERE day BETWEEN ? AND ? ORDER BY 1",
+                                      (start or "0000-00-00", end or "9999-99-99")).fetchall()
+        return [r[0] for r in rows]
+
+    def query(self, start, end, group_by, filters=None, limit=ARCHIVE_QUERY_LIMIT):
+        """
+        在資料庫內依 group_by (ARCHIVE_DIMENSIONS 的鍵) 彙總 start ~ end (含) 的杯數與金額，依金額由高到低排序。
+        filters: {維度: [值]}，同維度內為 OR、不同維度間為 AND。回傳 DataFrame。
+        """
+        dims = [d for d in group_by if d in ARCHIVE_DIMENSIONS]
+        where, params = ["day BETWEEN ? AND ?"], [str(start), str(end)]
+        for dim, values in (filters or {}).items():
+            if dim in ARCHIVE_DIMENSIONS and values:
+                where.append(f"{ARCHIVE_DIMENSIONS[dim]} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        select = [f'{ARCHIVE_DIMENSIONS[d]} AS "{d}"' for d in dims]
+        sql = (f'SELECT {", ".join(select + ["COUNT(*) AS 杯數", "SUM(price) AS 金額"])} FROM orders '
+               f'WHERE {" AND ".join(where)}'
+               + (f' GROUP BY {", ".join(ARCHIVE_DIMENSIONS[d] for d in dims)}' if dims else "")
+               + ' ORDER BY 金額 DESC LIMIT ?')
+        with self._lock:
+            return pd.read_sql_query(sql, self._conn, params=params + [limit])
+
+@st.cache_resource
+def get_order_archive(path=ORDER_ARCHIVE_PATH):
+    return OrderArchive(path)
+
+SETTLEMENT_STEPS = {"balances": "更新餘額", "logs": "寫入交易紀錄", "archive": "封存訂單歷史",
+                    "orders": "清除已結算訂單", "report": "產生報表"}
+
+class SettlementJournal:
+    def __init__(self, path=SETTLEMENT_JOURNAL_PATH, keep=SETTLEMENT_JOURNAL_KEEP):
+        self.path = path
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._records = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path): return []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return []
+
+    def _save(self):
+        # 只保留最近的紀錄，但未完成的結算一律保留
+        done = [r for r in self._records if r["status"] != "pending"]
+        drop = {id(r) for r in done[:max(0, len(self._records) - self.keep)]}
+        self._records = [r for r in self._records if id(r) not in drop]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._records, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def plan(self, update_map, logs, grid, total, expected=None):
+        """建立結算計畫 (尚未寫入日誌)；交易紀錄的時間在此固定，重試時寫出的內容完全相同。"""
+        now = datetime.now()
+        ts = now.strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "id": f"S{now.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:4]}",
+            "created": ts,
+            "status": "pending",
+            "balances": {str(k): int(v) for k, v in update_map.items()},
+            "expected": {str(k): int(v) for k, v in (expected or {}).items()} or None,
+            "conflicts": {},
+            "logs": [{"name": str(l["name"]), "change": int(l["change"]), "bal": int(l["bal"]),
+                      "note": str(l.get("note", "")), "ts": ts} for l in logs],
+            "log_done": [False] * len(logs),
+            "orders": [list(grid[0])] + [list(r) for r in grid[1:]] if grid else [],
+            "total": int(total),
+            "steps": {},
+            "report_job": None,
+            "error": None,
+        }
+
+    def begin(self, record):
+        with self._lock:
+            self._records.append(record)
+            self._save()
+        return record
+
+    def update(self, record, **kw):
+        with self._lock:
+            record.update(kw)
+            self._save()
+
+    def mark(self, record, step):
+        with self._lock:
+            record["steps"][step] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            record["error"] = None
+            if all(s in record["steps"] for s in SETTLEMENT_STEPS): record["status"] = "done"
+            self._save()
+
+    def pending(self):
+        """最近一筆未完成的結算 (沒有則回傳 None)。"""
+        with self._lock:
+            return next((r for r in reversed(self._records) if r["status"] == "pending"), None)
+
+    def history(self):
+        with self._lock:
+            return list(reversed(self._records))
+
+def run_settlement(backend, journal, record, submit_report=None, archive=None, on_orders=None):
+    """
+    依序執行 (或繼續) 結算的各步驟，已完成的步驟會略過。每個步驟都可重複執行：
+    餘額寫入的是目標值而非增減量、交易紀錄只補寫尚未成功的幾筆、訂單歷史每個結算只封存一次、
+    訂單只刪除仍在表上的已結算列。
+    第一次執行前先重讀訂單表：計畫中的訂單不全在表上 (例如已被另一次結算清除) 時中止，標記為 aborted。
+    失敗時把錯誤記在日誌並往外拋，結算維持 pending 等待重試 (429 已由 HTTP 層重試，這裡不再重試)。
+    on_orders(grid) 在清除已結算訂單後以清除後的訂單二維陣列呼叫 (供呼叫端更新快取)。
+    """
+    planned = record["orders"][1:]
+    fresh = None
+    if not record["steps"]:
+        fresh = backend.get_orders()
+        if len(plan_order_removal(fresh, planned)) < len(planned):
+            journal.update(record, status="aborted", error="預覽中的訂單已不在訂單表上 (可能已結算過)")
+            raise RuntimeError("預覽中的訂單已不在訂單表上 (可能已結算過)，請重新整理後再結算")
+
+    def step(name, fn):
+        if name in record["steps"]: return
+        try:
+            fn()
+        except Exception as e:
+            journal.update(record, error=f"{SETTLEMENT_STEPS[name]}：{e}")
+            raise
+        journal.mark(record, name)
+
+    def write_balances():
+        def resolved(final, found):
+            # 寫入前先把最終餘額記進日誌並清掉 expected：寫入成功但回應遺失 / 程序中斷時，
+            # 重試只會寫入同樣的絕對值，不會把衝突的人再以增減量重算一次 (重複扣款)
+            logs = [{**l, "bal": final.get(l["name"], l["bal"])} for l in record["logs"]]
+            conflicts = {**record.get("conflicts", {}), **{k: list(v) for k, v in found.items()}}
+            journal.update(record, balances={**record["balances"], **final}, logs=logs, conflicts=conflicts, expected=None)
+        res = backend.apply_balance_changes(record["balances"], record.get("expected"),
+                                            on_resolved=resolved if record.get("expected") is not None else None)
+        if res is None: raise RuntimeError("儲值表欄位辨識失敗")
+
+    def write_logs():
+        todo = [i for i, done in enumerate(record["log_done"]) if not done]
+        results = backend.log_transactions([record["logs"][i] for i in todo])
+        done = list(record["log_done"])
+        for i, ok in zip(todo, results): done[i] = bool(ok)
+        journal.update(record, log_done=done)
+        if not all(done):
+            raise RuntimeError(f"{done.count(False)} 筆交易紀錄寫入失敗")
+
+    def archive_orders():
+        if archive: archive.add_settlement(record["id"], record["orders"], record["created"][:10])
+
+    def clear_orders():
+        # 同一次執行中沿用開頭確認用的訂單表，不再多讀一次
+        grid = fresh or backend.get_orders()
+        deletes = plan_order_removal(grid, planned)
+        diff = {"updates": [], "deletes": deletes, "appends": []}
+        # 只刪除已結算的列 (單一 batchUpdate)，不整表清空：結算期間才寫入的訂單會留到下次結算；
+        # 以 grid 為快照比對，期間被別人新增、刪除而位移的列依內容找回位置
+        result = backend.apply_order_diff(diff, grid[1:]) if deletes else {"conflicts": [], "moved": 0}
+        if on_orders:
+            # 有位移或衝突時清除後的內容無法由快照推得，交給呼叫端重新讀取
+            on_orders(None if result["conflicts"] or result["moved"] else apply_order_diff_to_grid(grid, diff))
+
+    def report():
+        job_id = submit_report(record) if submit_report else None
+        journal.update(record, report_job=job_id)
+
+    step("balances", write_balances)
+    step("logs", write_logs)
+    step("archive", archive_orders)
+    step("orders", clear_orders)
+    step("report", report)
+    return record
+
+@st.cache_resource
+def get_settlement_journal(path=SETTLEMENT_JOURNAL_PATH):
+    return SettlementJournal(path)
 
 # ==========================================
 # 4. 主程式邏輯 (Main UI)
 # ==========================================
 
 # 4-1. 初始化與載入資料
+api_metrics = get_api_metrics()
+api_metrics.begin_rerun()
+# 這次 rerun 在 script 執行緒上發出的請求：管理員模式以較低優先權排隊
+rate_limiter = get_rate_limiter()
+rate_limiter.set_priority(PRIORITY_ADMIN if st.session_state.get("admin_mode", False) else PRIORITY_READ)
 client, s_info = get_google_client()
-sheet_url = s_info.get("spreadsheet")
+
+# 依網址參數選擇訂單群組 (未指定時使用第一個)
+tenants = load_tenants(st.secrets, s_info)
+room = st.query_params.get(TENANT_PARAM)
+if room and room not in tenants:
+    st.error(f"❌ 找不到訂單群組「{room}」。可用的群組：" +
+             "、".join(f"[{t.name}](?{TENANT_PARAM}={t.id})" for t in tenants.values()))
+    st.stop()
+tenant = tenants.get(room) or next(iter(tenants.values()), None)
+sheet_url = tenant.spreadsheet if tenant else None
+backend = get_storage_backend(client, sheet_url, tenant.storage_backend, tenant.sqlite_path,
+                              tenant.path(MENU_SNAPSHOT_PATH)) if sheet_url else None
+# 字型在背景預熱，結算產生 PDF 時已註冊完成
+font_provider = get_font_provider(s_info.get("font_path"), s_info.get("font_download", True))
+report_jobs = get_report_jobs()
+report_job_key = f"report_job:{tenant.id}" if tenant else "report_job"
+
+def submit_report(record):
+    """依結算日誌中的訂單快照送出背景報表工作，回傳 job id。"""
+    fname = f"飲料結算_{tenant.name + '_' if tenant.name else ''}{record['id'][1:9]}.pdf"
+    return report_jobs.submit(orders_frame(record["orders"]), record["total"], fname, font_provider,
+                              record.get("summary", True), get_drive_service(client), tenant.folder_id)
 
 current_menus = DEFAULT_MENUS
 all_toppings = {}
 
 if sheet_url:
-    menus, err = load_menu_from_sheet(client, sheet_url)
+    settlement_journal = get_settlement_journal(tenant.path(SETTLEMENT_JOURNAL_PATH))
+    order_archive = get_order_archive(tenant.path(ORDER_ARCHIVE_PATH))
+    # 會員儲值與訂單由各自的 fragment 讀取，這裡只讀點餐表單需要的菜單與加料
+    shared_cache = get_shared_cache(backend, sheet_url)
+    snapshot = load_data_snapshot(shared_cache)
+    menus, err = snapshot.menus, snapshot.menu_error
     if menus: current_menus = menus
     else: st.sidebar.warning(f"⚠️ 菜單讀取：{err}")
     
-    all_toppings = load_toppings_from_sheet(client, sheet_url)
+    all_toppings = snapshot.toppings
+    price_index = get_price_index(sheet_url, snapshot.versions["menu"], snapshot.versions["toppings"],
+                                  current_menus, all_toppings)
+    order_broadcast = get_order_broadcast(backend, sheet_url)
+    order_queue = get_order_queue(backend, sheet_url, tenant.path(ORDER_SPOOL_PATH))
+    order_feed = get_order_feed(backend, sheet_url)
 else:
     st.error("❌ 請在 Secrets 設定 Spreadsheet 網址")
     st.stop()
 
 # 4-2. 側邊欄設定
 st.sidebar.title("🥤 點餐設定")
+if len(tenants) > 1:
+    ids = list(tenants)
+    picked = st.sidebar.selectbox("🏢 訂單群組", ids, index=ids.index(tenant.id), format_func=lambda t: tenants[t].name)
+    if picked != tenant.id:
+        st.query_params[TENANT_PARAM] = picked
+        st.rerun()
 selected_store = st.sidebar.selectbox("請選擇店家", list(current_menus.keys()))
 menu_items = current_menus[selected_store]
 store_toppings = all_toppings.get(selected_store, {})
 
 st.sidebar.divider()
 st.sidebar.header("功能選單")
-admin_mode = st.sidebar.checkbox("開啟管理員/結算專區")
+admin_mode = st.sidebar.checkbox("開啟管理員/結算專區", key="admin_mode")
 
-# 4-3. 使用者點餐區
+# 4-3. 頁面分段重跑：點餐表單、管理員專區、訂單列表各自是一個 st.fragment，
+# 操作其中一段的元件只重跑該段，不會重新讀取資料或重畫其他區塊。
+def fragment(scope, run_every=None, priority=PRIORITY_READ, quiet=False):
+    """把一段 UI 包成 st.fragment；單獨重跑時另計 API 監控並以指定優先權排隊。"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with api_metrics.fragment_rerun(scope, quiet), rate_limiter.priority(priority):
+                return fn(*args, **kwargs)
+        return st.fragment(run, run_every=run_every)
+    return wrap
+
+# 4-4. 使用者點餐區
 st.header(f"📍 目前店家：{selected_store}")
+if tenant.name: st.caption(f"🏢 訂單群組：{tenant.name}")
+
+@fragment("點餐表單")
+def order_form(selected_store, menu_items, store_toppings):
+    col1, col2 = st.columns(2)
+    with col1:
+        user_name = st.text_input("你的名字 (必填)", key="u_name")
+    with col2:
+        item_name = st.selectbox("飲料品項", list(menu_items.keys()), key="u_item")
+        price_table = menu_items[item_name]
+
+    col3, col4, col5 = st.columns(3)
+    with col3:
+        size = st.selectbox("大小", list(price_table.keys()), key="u_size")
+        base_price = price_table[size]
+    with col4:
+        sugar = st.selectbox("甜度", SUGAR_OPTS, key="u_sugar")
+    with col5:
+        ice = st.selectbox("冰塊", ICE_OPTS, key="u_ice")
+
+    # 加料區
+    selected_toppings = []
+    if store_toppings:
+        st.write("---")
+        st.subheader("🍬 加料區")
+        # 選項直接使用加料名稱，顯示時再加上價格
+        selected_toppings = st.multiselect("選擇配料", list(store_toppings.keys()), key="u_top",
+                                           format_func=lambda t: f"{t} (+{store_toppings.get(t, 0)})")
 
-col1, col2 = st.columns(2)
-with col1:
-    user_name = st.text_input("你的名字 (必填)", key="u_name")
-with col2:
-    item_name = st.selectbox("飲料品項", list(menu_items.keys()), key="u_item")
-    price_table = menu_items[item_name]
-
-col3, col4, col5 = st.columns(3)
-with col3:
-    size = st.selectbox("大小", list(price_table.keys()), key="u_size")
-    base_price = price_table[size]
-with col4:
-    sugar = st.selectbox("甜度", SUGAR_OPTS, key="u_sugar")
-with col5:
-    ice = st.selectbox("冰塊", ICE_OPTS, key="u_ice")
-
-# 加料區
-topping_cost = 0
-selected_toppings = []
-if store_toppings:
+    topping_cost = price_index.topping_price(selected_store, selected_toppings)
+    final_price = base_price + topping_cost
     st.write("---")
-    st.subheader("🍬 加料區")
-    top_opts = [f"{k} (+{v})" for k, v in store_toppings.items()]
-    picked_tops = st.multiselect("選擇配料", top_opts, key="u_top")
-    
-    for pt in picked_tops:
-        tn = pt.split(" (+")[0]
-        tp = store_toppings[tn]
-        topping_cost += tp
-        selected_toppings.append(tn)
-
-final_price = base_price + topping_cost
-st.write("---")
-st.info(f"💰 **總金額：{final_price} 元** (飲料 {base_price} + 加料 {topping_cost})")
-user_note = st.text_input("備註", key="u_note")
-
-if st.button("送出訂單", type="primary", use_container_width=True):
-    if not user_name:
-        st.error("❌ 請輸入名字！")
-    else:
-        try:
-            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            t_str = ", ".join(selected_toppings)
-            
-            # 欄位順序：時間, 店家, 姓名, 品項, 大小, 加料, 價格, 甜度, 冰塊, 備註
-            row = [ts, selected_store, user_name, item_name, size, t_str, final_price, sugar, ice, user_note]
+    st.info(f"💰 **總金額：{final_price} 元** (飲料 {base_price} + 加料 {topping_cost})")
+    user_note = st.text_input("備註", key="u_note")
+
+    if st.button("送出訂單", type="primary", use_container_width=True):
+        if not user_name:
+            st.error("❌ 請輸入名字！")
+        else:
+            try:
+                ts = datetime.now().strftime(ORDER_TIME_FORMAT)
+                t_str = ", ".join(selected_toppings)
             
-            sh = client.open_by_url(sheet_url)
-            ws = sh.get_worksheet(0)
-            ws.append_row(row)
+                # 欄位順序：時間, 店家, 姓名, 品項, 大小, 加料, 價格, 甜度, 冰塊, 備註
+                row = [ts, selected_store, user_name, item_name, size, t_str, final_price, sugar, ice, user_note]
             
-            get_orders_from_sheet.clear() # 清快取
-            st.success(f"✅ {user_name} 點餐成功！")
-            st.balloons()
-        except Exception as e:
-            st.error(f"寫入失敗: {e}")
+                # 先寫入本機佇列，由背景執行緒批次寫入 Sheet
+                order_queue.submit(row)
+                st.success(f"✅ {user_name} 點餐成功！")
+                st.balloons()
+            except Exception as e:
+                st.error(f"寫入失敗: {e}")
+
+order_form(selected_store, menu_items, store_toppings)
 
 # ==========================================
 # 5. 管理員專區 (Admin UI)
 # ==========================================
-if admin_mode:
+# 結算報表工作狀態：工作進行中時定期自動更新，不需重跑整個管理員專區
+def report_status(job_id, live):
+    job = report_jobs.get(job_id)
+    if job:
+        st.markdown(f"#### 📄 結算報表 `{job['id']}`：{REPORT_STATUS[job['status']]}")
+        if job["finished"]:
+            # 進行中時以計時器重跑；完成後整頁重跑一次以停止計時
+            if live: st.rerun()
+            if job["link"]: st.markdown(f"{job['message']}：[{job['filename']}]({job['link']})")
+            elif job["message"]: getattr(st, job["level"] or "info")(job["message"])
+            if font_provider.is_fallback:
+                st.warning(f"⚠️ 找不到中文 TrueType 字型，PDF 改用內建字型 {FONT_CID_FALLBACK}。可在 Secrets 設定 `font_path` 或將字型放入 `{FONT_BUNDLE_DIR}/`。")
+            pdf_data = report_jobs.pdf_bytes(job["id"])
+            # 提供手動下載按鈕 (以防上傳失敗)
+            if pdf_data:
+                st.download_button(
+                    label="📄 手動下載 PDF 結算單",
+                    data=pdf_data,
+                    file_name=job["filename"],
+                    mime='application/pdf',
+                )
+        else:
+            st.caption(f"每 {REPORT_STATUS_REFRESH} 秒自動更新狀態…")
+
+# 結算清除訂單後立即把清除後的訂單放入快取 (再於背景向 Sheet 確認)：
+# 背景重新讀取完成前，下一次結算預覽也不會把已結算的訂單配上扣款後的餘額再扣一次
+def put_settled_orders(grid):
+    order_feed.invalidate()
+    shared_cache.put("orders", grid if grid is not None else backend.get_orders())
+
+# 管理員專區只在操作其中的元件時重跑 (編輯中的表格不會被訂單列表的自動更新打斷)
+@fragment("管理員專區", priority=PRIORITY_ADMIN)
+def admin_panel():
     st.divider()
     st.header("👮‍♂️ 管理員專區")
     
-    # 讀取訂單
-    raw_data = get_orders_from_sheet(client, sheet_url)
+    queued = order_queue.pending()
+    if queued:
+        st.warning(f"⏳ 尚有 {len(queued)} 筆訂單等待寫入 Google Sheet，結算前會先自動寫入。")
+        if order_queue.last_error: st.caption(f"最近一次寫入錯誤：{order_queue.last_error}")
+        failed = [e for e in queued if e["status"] == "failed"]
+        if failed:
+            st.caption(f"❌ {len(failed)} 筆訂單寫入時發生無法確定結果的錯誤，請先確認 Sheet 上沒有這些訂單再重試。")
+            if st.button("🔁 重新寫入失敗的訂單"):
+                if order_queue.flush(): st.success("✅ 已寫入")
+                else: st.error(f"寫入失敗：{order_queue.last_error}")
+    
+    # 讀取訂單 (與訂單列表共用同一個 DataFrame)
+    raw_data, df = load_orders_frame(shared_cache, sheet_url)
     
     if len(raw_data) > 1:
         headers = raw_data[0]
-        # 過濾空白標題
-        valid_idx = [i for i, h in enumerate(headers) if h.strip()]
-        if not valid_idx:
+        if df is None:
             st.error("無法讀取訂單標題，請檢查 Google Sheet")
         else:
-            clean_headers = [headers[i] for i in valid_idx]
-            clean_rows = [[r[i] if i < len(r) else "" for i in valid_idx] for r in raw_data[1:]]
-            
-            df = pd.DataFrame(clean_rows, columns=clean_headers)
-            
-            # 確保價格為數字
-            for col in ['價格', 'Price']:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            
             total = df['價格'].sum() if '價格' in df.columns else 0
             st.metric("💵 今日總營業額", f"{int(total)} 元")
 
@@ -512,8 +3120,8 @@ if admin_mode:
             all_items = sorted(list(all_items))
             all_sizes = ["中杯", "大杯", "單一規格", "L", "M"]
 
-            # 插入刪除欄位
-            df_edit = df.copy()
+            # 編輯用的副本：category 欄改回一般欄位，才能選入目前沒有出現過的值；再插入刪除欄位
+            df_edit = df.astype({c: object for c in ORDER_CATEGORY_COLS if c in df.columns})
             df_edit.insert(0, "刪除", False)
 
             edited_df = st.data_editor(
@@ -523,6 +3131,7 @@ if admin_mode:
                 key="order_editor",
                 column_config={
                     "刪除": st.column_config.CheckboxColumn("刪除", width="small"),
+                    "時間": st.column_config.DatetimeColumn("時間", format="YYYY-MM-DD HH:mm:ss"),
                     "店家": st.column_config.SelectboxColumn("店家", options=all_stores, required=True),
                     "品項": st.column_config.SelectboxColumn("品項", options=all_items, required=True),
                     "大小": st.column_config.SelectboxColumn("大小", options=all_sizes, required=True),
@@ -534,47 +3143,36 @@ if admin_mode:
 
             if st.button("💾 儲存訂單變更 (Save Changes)"):
                 try:
-                    # 過濾刪除
-                    rows_to_save = edited_df[edited_df["刪除"] == False].drop(columns=["刪除"])
+                    # 過濾刪除 (新增的列「刪除」為空值，視為保留)
+                    rows_to_save = edited_df[edited_df["刪除"] != True].drop(columns=["刪除"])
                     
-                    # 自動重算價格
-                    for idx, row in rows_to_save.iterrows():
-                        try:
-                            r_store, r_item, r_size = row.get('店家'), row.get('品項'), row.get('大小')
-                            r_tops = str(row.get('加料', ""))
-                            
-                            # 基底價格
-                            base = 0
-                            if r_store in current_menus and r_item in current_menus[r_store]:
-                                sizes = current_menus[r_store][r_item]
-                                base = sizes.get(r_size, sizes.get("單一規格", 0))
-                            
-                            # 加料價格
-                            top_c = 0
-                            if r_tops and r_store in all_toppings:
-                                for t in r_tops.split(","):
-                                    t = t.strip()
-                                    if t in all_toppings[r_store]: top_c += all_toppings[r_store][t]
-                            
-                            new_p = base + top_c
-                            if new_p > 0: rows_to_save.at[idx, '價格'] = new_p
-                        except: pass
+                    # 自動重算價格 (對不到菜單的列保留原價)
+                    if '價格' in rows_to_save.columns:
+                        new_p = price_index.price_orders(rows_to_save)
+                        rows_to_save['價格'] = new_p.where(new_p > 0, rows_to_save['價格'])
                     
                     recalc_total = rows_to_save['價格'].sum()
                     st.toast(f"已自動重新計算價格，總金額：{recalc_total} 元")
 
-                    # 寫回 Sheet
-                    new_headers = rows_to_save.columns.tolist()
-                    new_vals = rows_to_save.astype(str).values.tolist()
-                    
-                    sh = client.open_by_url(sheet_url)
-                    ws = sh.get_worksheet(0)
-                    ws.clear()
-                    ws.update(values=[new_headers] + new_vals)
-                    
-                    get_orders_from_sheet.clear()
-                    st.success("✅ 訂單更新成功！")
-                    st.rerun()
+                    # 只寫回有變動的部分 (修改的儲存格、刪除列、新增列)
+                    diff = diff_order_rows(headers, raw_data[1:], rows_to_save, base_df=df)
+                    if not (diff["updates"] or diff["deletes"] or diff["appends"]):
+                        st.info("沒有需要儲存的變更")
+                    else:
+                        # 以快照比對：別人在這段期間改過或刪掉的列不會被覆蓋
+                        result = backend.apply_order_diff(diff, raw_data[1:])
+                        
+                        order_feed.invalidate()
+                        if result["conflicts"] or result["moved"]:
+                            shared_cache.invalidate("orders")
+                        else:
+                            shared_cache.put("orders", apply_order_diff_to_grid(raw_data, diff))
+                        if result["conflicts"]:
+                            st.warning(f"⚠️ 有 {len(result['conflicts'])} 筆訂單在編輯期間已被其他人修改或刪除，這些列的變更未套用："
+                                       + "、".join(f"第 {r + 2} 列" for r in result["conflicts"]) + "。請重新整理後再修改。")
+                        else:
+                            st.success("✅ 訂單更新成功！")
+                            st.rerun()
                 except Exception as e:
                     st.error(f"儲存失敗: {e}")
 
@@ -582,31 +3180,16 @@ if admin_mode:
             st.divider()
             st.subheader("💰 餘額扣款與結算")
             
-            balances = load_balances_from_sheet(client, sheet_url)
+            balances = shared_cache.value("balances")
             
             if balances is None:
                 st.warning("請先建立「會員儲值」分頁以使用扣款功能")
             elif '姓名' in df.columns and '價格' in df.columns:
-                # 計算每人消費
-                spending = df.groupby('姓名')['價格'].sum().reset_index()
-                spending.columns = ['姓名', '今日消費']
-                
-                # 準備結算預覽表
-                report_data = []
-                for _, row in spending.iterrows():
-                    name = row['姓名']
-                    cost = int(row['今日消費'])
-                    curr = balances.get(name, 0)
-                    remain = curr - cost
-                    status = "✅ 足夠" if remain >= 0 else "❌ 不足"
-                    report_data.append({
-                        "姓名": name, "目前存款": curr, "今日消費": cost, 
-                        "扣款後餘額": remain, "狀態": status
-                    })
+                # 計算每人消費並準備結算預覽表
+                bal_df = build_settlement_frame(df, balances)
                 
-                if report_data:
-                    bal_df = pd.DataFrame(report_data)
-                    st.caption("👇 請確認「扣款後餘額」，按下確認鍵將執行：更新餘額、寫Log、產PDF、上傳雲端、清空訂單。")
+                if not bal_df.empty:
+                    st.caption("👇 請確認「扣款後餘額」，按下確認鍵將執行：更新餘額、寫Log、封存訂單歷史、產PDF、上傳雲端、清空訂單。")
                     
                     edited_bal_df = st.data_editor(
                         bal_df,
@@ -617,96 +3200,43 @@ if admin_mode:
                         }
                     )
                     
-                    if st.button("💸 確認扣款並更新儲值表 (End of Day)", type="primary"):
+                    with_summary = st.checkbox("PDF 附上店家 / 人員小計", value=True)
+                    dry_run = st.checkbox("🧪 試算 (Dry-run)：只列出將執行的變更，不寫入任何資料")
+                    
+                    if settlement_journal.pending():
+                        st.warning("⚠️ 有尚未完成的結算，請先於下方「未完成的結算」繼續執行，避免重複扣款。")
+                    elif st.button("💸 確認扣款並更新儲值表 (End of Day)", type="primary"):
                         status_box = st.empty()
                         status_box.info("⏳ 正在處理結算流程...")
                         
                         try:
-                            sh = client.open_by_url(sheet_url)
-                            ws_bal = sh.worksheet("會員儲值")
-                            
-                            # 1. 準備更新資料
-                            update_map = {r['姓名']: r['扣款後餘額'] for _, r in edited_bal_df.iterrows()}
-                            logs = []
-                            for _, r in edited_bal_df.iterrows():
-                                diff = r['扣款後餘額'] - r['目前存款']
-                                if diff != 0:
-                                    logs.append({"name": r['姓名'], "change": diff, "bal": r['扣款後餘額'], "note": f"消費 {r['今日消費']}"})
+                            # 0. 先把佇列中的訂單寫入，避免清空訂單時遺漏
+                            if not dry_run and order_queue.pending() and not order_queue.flush():
+                                raise RuntimeError(f"仍有訂單尚未寫入 Sheet，請稍後再試 ({order_queue.last_error})")
                             
-                            # 2. 更新儲值表 (保留原順序，新增新人)
-                            bal_rows = ws_bal.get_all_values()
-                            if not bal_rows: bal_rows = [["姓名", "存款餘額"]]
+                            # 1. 建立結算計畫：只會清除預覽中的訂單，flush 後才寫入的訂單保留到下次結算
+                            update_map, logs, expected = settlement_changes(edited_bal_df)
+                            record = settlement_journal.plan(update_map, logs, raw_data, total, expected)
+                            record["summary"] = with_summary
                             
-                            h_bal = bal_rows[0]
-                            try:
-                                i_n = -1
-                                for k in ["姓名", "Name", "員工", "員工姓名"]: 
-                                    if k in h_bal: i_n = h_bal.index(k)
-                                i_b = -1
-                                for k in ["存款餘額", "餘額", "存款", "Balance", "金額", "目前餘額"]: 
-                                    if k in h_bal: i_b = h_bal.index(k)
-                            except: i_n, i_b = -1, -1
-                            
-                            if i_n != -1 and i_b != -1:
-                                updated_names = set()
-                                for i in range(1, len(bal_rows)):
-                                    r = bal_rows[i]
-                                    if len(r) > i_n:
-                                        nm = r[i_n].strip()
-                                        if nm in update_map:
-                                            while len(r) <= i_b: r.append("")
-                                            r[i_b] = str(update_map[nm])
-                                            updated_names.add(nm)
-                                
-                                for nm, val in update_map.items():
-                                    if nm not in updated_names:
-                                        nr = [""] * (max(i_n, i_b) + 1)
-                                        nr[i_n], nr[i_b] = nm, str(val)
-                                        bal_rows.append(nr)
-                                
-                                ws_bal.clear()
-                                ws_bal.update(values=bal_rows)
-                                
-                                # 3. 寫Log
-                                for l in logs:
-                                    log_transaction(client, sheet_url, l["name"], l["change"], l["bal"], l["note"])
-                                
-                                # 4. PDF & Drive (改進：上傳失敗不中斷流程)
-                                status_box.info("⏳ 上傳報表中...")
-                                pdf = generate_pdf_report(df, int(total))
-                                fname = f"飲料結算_{datetime.now().strftime('%Y%m%d')}.pdf"
-                                link = upload_to_drive(pdf, fname, s_info)
-                                
-                                drive_msg = ""
-                                if link:
-                                    drive_msg = f"📂 [PDF 已上傳至雲端]({link})"
-                                else:
-                                    # 上傳失敗提示 (但程式會繼續執行下去)
-                                    drive_msg = "⚠️ PDF 上傳略過 (機器人儲存空間不足，請使用下方按鈕手動下載)"
-
-                                # 5. 清空訂單
-                                status_box.info("⏳ 清空訂單中...")
-                                ws_ord = sh.get_worksheet(0)
-                                ws_ord.clear()
-                                ws_ord.append_row(['時間', '店家', '姓名', '品項', '大小', '加料', '價格', '甜度', '冰塊', '備註'])
-                                
-                                load_balances_from_sheet.clear()
-                                get_orders_from_sheet.clear()
-                                
-                                status_box.success(f"✅ 結算完成！餘額已更新、訂單已清空。")
-                                if link: st.markdown(drive_msg)
+                            if dry_run:
+                                status_box.info(f"🧪 試算結果 (未寫入)：{len(logs)} 人餘額變動、{len(logs)} 筆交易紀錄、"
+                                                f"封存並清除 {len(record['orders']) - 1} 筆訂單、產生 PDF 報表。")
+                                st.dataframe(pd.DataFrame(record["logs"]), use_container_width=True)
+                            else:
+                                # 2. 先寫入日誌再執行：更新餘額 → 交易紀錄 → 清除已結算訂單 → 背景產生報表
+                                settlement_journal.begin(record)
+                                run_settlement(backend, settlement_journal, record, submit_report, order_archive,
+                                               on_orders=put_settled_orders)
+                                st.session_state[report_job_key] = record["report_job"]
+                                shared_cache.put("balances", {**balances, **record["balances"]})
                                 
-                                # 提供手動下載按鈕 (以防上傳失敗)
-                                st.download_button(
-                                    label="📄 手動下載 PDF 結算單",
-                                    data=pdf,
-                                    file_name=fname,
-                                    mime='application/pdf',
-                                )
+                                status_box.success(f"✅ 結算 `{record['id']}` 完成！餘額已更新、訂單已清空。報表工作 `{record['report_job']}` 正在背景產生與上傳。")
+                                if record["conflicts"]:
+                                    st.warning("⚠️ 以下人員的餘額在預覽後被修改過，已改以最新餘額扣款：" +
+                                               "、".join(f"{n} ({e}→{c}，扣款後 {f})" for n, (e, c, f) in record["conflicts"].items()))
                                 
                                 if st.button("🔄 重新整理頁面"): st.rerun()
-                            else:
-                                st.error("儲值表欄位辨識失敗")
                         except Exception as e:
                             st.error(f"結算失敗: {e}")
                 else:
@@ -723,19 +3253,195 @@ if admin_mode:
     else:
         st.info("📭 目前訂單列表是空的")
 
+    # --- 未完成的結算 (上次中途失敗或程序重啟) ---
+    pending_settlement = settlement_journal.pending()
+    if pending_settlement:
+        with st.container(border=True):
+            done_steps = "、".join(SETTLEMENT_STEPS[s] for s in SETTLEMENT_STEPS if s in pending_settlement["steps"]) or "無"
+            todo_steps = "、".join(SETTLEMENT_STEPS[s] for s in SETTLEMENT_STEPS if s not in pending_settlement["steps"])
+            st.warning(f"⚠️ 未完成的結算 `{pending_settlement['id']}` ({pending_settlement['created']})\n\n"
+                       f"已完成：{done_steps}；待執行：{todo_steps}")
+            if pending_settlement["error"]: st.caption(f"最近一次錯誤：{pending_settlement['error']}")
+            if st.button("▶️ 繼續執行結算", type="primary"):
+                try:
+                    run_settlement(backend, settlement_journal, pending_settlement, submit_report, order_archive,
+                                   on_orders=put_settled_orders)
+                    st.session_state[report_job_key] = pending_settlement["report_job"]
+                    shared_cache.invalidate("balances")
+                    st.success(f"✅ 結算 `{pending_settlement['id']}` 完成！")
+                except Exception as e:
+                    st.error(f"結算失敗: {e}")
+
+    # --- 結算報表工作狀態 ---
+    job = report_jobs.get(st.session_state.get(report_job_key))
+    if job:
+        live = not job["finished"]
+        fragment("結算報表", REPORT_STATUS_REFRESH if live else None, PRIORITY_ADMIN)(report_status)(job["id"], live)
+
+    # --- D. 快取狀態 ---
+    with st.expander("🗄️ 快取狀態 (全程序共用)"):
+        st.caption("hit：直接使用快取；stale：先回傳舊資料並於背景更新；miss：同步讀取；refresh：背景更新完成次數。")
+        st.dataframe(pd.DataFrame(shared_cache.stats()), use_container_width=True)
+
+    # --- E. 效能監控 ---
+    with st.expander("📈 效能監控 (Sheets / Drive API)"):
+        st.caption(f"自程序啟動以來的累計統計；同時每 {METRICS_FLUSH_INTERVAL} 秒寫出 `{METRICS_SNAPSHOT_PATH}` 與逐筆紀錄 `{METRICS_LOG_PATH}`。")
+        st.dataframe(pd.DataFrame(rate_limiter.snapshot()), use_container_width=True, hide_index=True)
+        perf = api_metrics.stats()
+        if perf: st.dataframe(pd.DataFrame(perf), use_container_width=True, hide_index=True)
+        else: st.write("尚無 API 呼叫")
+        st.markdown("**最近的 rerun** (本次 rerun 仍在進行，不在列表中)")
+        reruns = api_metrics.reruns()
+        if reruns: st.dataframe(pd.DataFrame(reruns), use_container_width=True, hide_index=True)
+        errs = api_metrics.errors()
+        if errs:
+            st.markdown("**最近的錯誤**")
+            st.dataframe(pd.DataFrame(errs), use_container_width=True, hide_index=True)
+
+    # --- F. 訂單歷史分析 ---
+    with st.expander("📚 訂單歷史分析 (已結算訂單)"):
+        info = order_archive.summary()
+        if not info["orders"]:
+            st.write("尚無封存的訂單，每次結算後會自動寫入。")
+        else:
+            first = datetime.strptime(info["first"], "%Y-%m-%d").date()
+            last = datetime.strptime(info["last"], "%Y-%m-%d").date()
+            h1, h2 = st.columns(2)
+            with h1:
+                picked = st.date_input("日期區間", value=(max(first, last - pd.Timedelta(days=29)), last),
+                                       min_value=first, max_value=last, key="hist_range")
+            with h2:
+                group_by = st.multiselect("分組依據", list(ARCHIVE_DIMENSIONS), default=["姓名"], key="hist_group")
+            # 區間只選了起始日時先當成單日查詢
+            start, end = (picked[0], picked[-1]) if isinstance(picked, (tuple, list)) and picked else (picked, picked)
+            f1, f2 = st.columns(2)
+            with f1:
+                f_store = st.multiselect("店家", order_archive.distinct("店家", start, end), key="hist_store")
+            with f2:
+                f_name = st.multiselect("姓名", order_archive.distinct("姓名", start, end), key="hist_name")
+            t0 = time.perf_counter()
+            result = order_archive.query(start, end, group_by, {"店家": f_store, "姓名": f_name})
+            st.caption(f"共 {info['orders']} 筆歷史訂單 ({info['first']} ~ {info['last']})；"
+                       f"本次查詢 {(time.perf_counter() - t0) * 1000:.1f} ms，最多顯示 {ARCHIVE_QUERY_LIMIT} 列。")
+            st.dataframe(result, use_container_width=True, hide_index=True)
+
+    # --- G. 菜單編譯結果 ---
+    menu_info = backend.menu_report()
+    if menu_info:
+        skipped = len(menu_info["rejected"])
+        with st.expander(f"🧾 菜單編譯結果{f' (略過 {skipped} 列)' if skipped else ''}"):
+            st.caption(f"版本 {menu_info['version']}・內容雜湊 `{menu_info['hash'][:12] if menu_info['hash'] else '-'}`・"
+                       f"編譯於 {menu_info['compiled_at']}・共 {menu_info['rows']} 列。"
+                       f"每 {MENU_CHECK_INTERVAL} 秒檢查試算表修改時間，有修改才重新編譯。")
+            if menu_info["error"]: st.error(f"菜單編譯失敗：{menu_info['error']}")
+            if menu_info["rejected"]:
+                st.markdown("**略過的列** (請修正「菜單設定」分頁)")
+                st.dataframe(pd.DataFrame(menu_info["rejected"]), use_container_width=True, hide_index=True)
+            if menu_info["warnings"]:
+                st.markdown("**提醒**")
+                st.dataframe(pd.DataFrame(menu_info["warnings"]), use_container_width=True, hide_index=True)
+            if st.button("🔄 立即重新編譯菜單"):
+                backend.recompile_menu()
+                shared_cache.invalidate("menu")
+                st.toast("已排入重新編譯，稍後重新整理即可看到結果")
+
+if admin_mode:
+    admin_panel()
+
 # ==========================================
 # 6. 訂單列表 (Footer)
 # ==========================================
 st.divider()
 st.subheader("📊 今日訂單列表")
-data_disp = get_orders_from_sheet(client, sheet_url)
-if len(data_disp) > 1:
-    h = data_disp[0]
-    r = data_disp[1:]
-    v_idx = [i for i, x in enumerate(h) if x.strip()]
-    if v_idx:
-        c_h = [h[i] for i in v_idx]
-        c_r = [[row[i] if i < len(row) else "" for i in v_idx] for row in r]
-        st.dataframe(pd.DataFrame(c_r, columns=c_h), use_container_width=True)
-else:
-    st.info("尚無訂單")
+
+# 訂單列表：每 ORDER_LIST_REFRESH 秒依推播序號重新繪製；顯示用的表格每個序號只建立一次，所有 session 共用。
+# 兩次重繪之間的新訂單由 order_live 依推播事件 (delta) 即時列出，不必為了低延遲而高頻率重繪整份列表。
+def get_order_view(sheet_url, seq, cache, queue):
+    return get_versioned(sheet_url, "order_view").get(seq, lambda: build_order_view(cache, sheet_url, queue))
+
+def build_order_view(cache, sheet_url, queue):
+    data_disp, disp_df = load_orders_frame(cache, sheet_url, live=True)
+    pending_disp = queue.pending()
+    if len(data_disp) <= 1:
+        disp_df = None
+    elif disp_df is not None and pending_disp:
+        # 共用的 DataFrame 不可修改：加上狀態欄時產生新的 DataFrame
+        disp_df = pd.concat([pd.Series("✅ 已送出", index=disp_df.index, name="狀態"), disp_df], axis=1)
+
+    # 尚未寫入 Sheet 的訂單 (佇列中)
+    if pending_disp:
+        p_df = orders_frame([ORDER_HEADERS] + [e["row"] for e in pending_disp])
+        p_df.insert(0, "狀態", ["❌ 寫入失敗 (需手動重試)" if e["status"] == "failed" else "⏳ 等待寫入" for e in pending_disp])
+        disp_df = p_df if disp_df is None else pd.concat([disp_df, p_df], ignore_index=True)
+    return disp_df
+
+live_seen_key = f"order_seen:{tenant.id}"
+
+@fragment("新訂單", run_every=ORDER_LIVE_REFRESH, quiet=True)
+def order_live():
+    rows, replaced = live_order_rows(order_broadcast.since(st.session_state.get(live_seen_key, 0)))
+    if rows:
+        live_df = orders_frame([ORDER_HEADERS] + [r for _, r in rows])
+        live_df.insert(0, "狀態", [status for status, _ in rows])
+        st.caption(f"🆕 最新 {len(rows)} 筆訂單 (列表將於 {ORDER_LIST_REFRESH} 秒內更新)")
+        st.dataframe(live_df, use_container_width=True, hide_index=True)
+    elif replaced:
+        st.caption(f"✏️ 訂單已修改，列表將於 {ORDER_LIST_REFRESH} 秒內更新")
+
+@fragment("訂單列表", run_every=ORDER_LIST_REFRESH, quiet=True)
+def order_list():
+    order_broadcast.watch()
+    seq = order_broadcast.seq
+    st.session_state[live_seen_key] = seq
+    disp_df = get_order_view(sheet_url, seq, shared_cache, order_queue)
+
+    tab_list, tab_tally = st.tabs(["📋 訂單明細", "🧮 叫貨統計"])
+    with tab_list:
+        if disp_df is not None:
+            st.dataframe(disp_df, use_container_width=True)
+        else:
+            st.info("尚無訂單")
+    with tab_tally:
+        order_tally_view()
+    last = order_broadcast.last_event_at()
+    st.caption(f"每 {ORDER_LIST_REFRESH} 秒自動更新" + (f"，最後變動 {datetime.fromtimestamp(last).strftime('%H:%M:%S')}" if last else "")
+               + f"；直接在 Sheet 修改的內容約 {ORDER_POLL_INTERVAL} 秒內反映")
+
+# 叫貨統計：依店家分組的精簡表格，可下載文字或單頁 PDF 給店家
+def order_tally_view():
+    tally = load_order_tally(shared_cache, sheet_url, live=True)
+    per_store = tally.stores()
+    if not per_store:
+        st.info("尚無已送出的訂單")
+        return
+    picked = st.selectbox("店家", ["全部"] + list(per_store), key="tally_store",
+                          format_func=lambda s: s if s == "全部" else f"{s} ({per_store[s][0]} 杯)")
+    store = None if picked == "全部" else picked
+    rows = tally.rows(store)
+    for name, (cups, amount) in per_store.items():
+        if store and name != store: continue
+        st.markdown(f"**{name}**：{cups} 杯 / {amount} 元")
+        st.dataframe(pd.DataFrame([r for r in rows if r["店家"] == name]).drop(columns=["店家"]),
+                     use_container_width=True, hide_index=True)
+    
+    title = f"叫貨單{'：' + store if store else ''} ({tally.updated.strftime('%Y-%m-%d %H:%M')})"
+    text = tally_text(rows, title)
+    fname = f"叫貨單_{store or '全部'}_{tally.updated.strftime('%H%M')}"
+    c1, c2 = st.columns(2)
+    with c1:
+        st.download_button("📝 下載文字叫貨單", text, file_name=f"{fname}.txt", mime="text/plain",
+                           use_container_width=True)
+    with c2:
+        # 字型尚未預熱完成時先用內建字型，不讓訂單列表等待
+        font = font_provider.font_name(timeout=0)
+        st.download_button("📄 下載 PDF 叫貨單 (一頁)", tally_pdf(sheet_url, tally.version, picked, font, rows, title),
+                           file_name=f"{fname}.pdf", mime="application/pdf", use_container_width=True)
+    with st.expander("📋 複製文字"):
+        st.code(text, language=None)
+
+# 整頁 rerun 時訂單列表會一併重繪，新訂單提示從目前的序號開始
+st.session_state[live_seen_key] = order_broadcast.seq
+order_live()
+order_list()
+
+api_metrics.end_rerun()
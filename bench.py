@@ -0,0 +1,503 @@
+"""
+效能基準測試 (Benchmark)：以本機模擬的 Google Sheets / Drive 驅動 app.py 真正的程式路徑
+(點餐送出與背景寫入、管理員儲存、結算)，回報每個操作的 API 呼叫數、p50 / p95 延遲與吞吐量。
+
+    python bench.py                          # 預設 20 人同時點餐、每人 5 杯
+    python bench.py --users 50 --orders 10 --latency 0.08 --quota-rate 0.05
+    python bench.py --check                  # API 呼叫數超過 bench_baseline.json 即以非 0 結束
+    python bench.py --write-baseline         # 以這次的結果更新基準
+
+延遲與配額錯誤是模擬值，只適合比較同一台機器上改版前後的差異；回歸檢查只看 API 呼叫數
+(在 --quota-rate 0 時是確定值)。注入的 429 由 app.py 的限速器與 HTTP 層重試 (send_with_quota) 處理，
+重試後仍失敗的操作會在報表中標示錯誤，不會中斷其他操作的量測。
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from gspread.exceptions import APIError
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+BASELINE_TOLERANCE = 0.10   # API 呼叫數允許超出基準的比例 (至少容許多 1 次)
+BENCH_QUOTA_PER_MIN = 100000   # 基準測試的限速額度放寬，只讓 429 重試影響結果
+READ_CALLS = {"get_all_values", "values_batch_get", "open_by_url", "worksheets", "worksheet", "get_worksheet",
+              "get_lastUpdateTime"}
+
+# ==========================================
+# 1. 模擬的 Google Sheets / Drive
+# ==========================================
+class FakeResponse:
+    """gspread.APIError 需要的最小 Response 介面。"""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._body
+
+
+class FakeAPI:
+    """所有模擬物件共用：記錄呼叫次數、注入延遲與配額錯誤。"""
+
+    def __init__(self, latency=0.0, jitter=0.5, quota_rate=0.0, seed=0, send=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_rate = quota_rate
+        self.send = send   # send(name, attempt)：以 app 的 HTTP 層限速 / 重試包住每次呼叫 (相當於 http_client.request)
+        self.calls = Counter()
+        self.quota_errors = 0
+        self.lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def call(self, name):
+        if self.send is None: return self._attempt(name)
+        return self.send(name, lambda: self._attempt(name))
+
+    def _attempt(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            fail = self._rng.random() < self.quota_rate
+            delay = self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)) if self.latency else 0
+        if delay: time.sleep(delay)
+        if fail:
+            with self.lock: self.quota_errors += 1
+            raise APIError(FakeResponse(429, "Quota exceeded for quota metric 'Write requests' (simulated)"))
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+
+def _cell_value(c):
+    u = c.get("userEnteredValue", {})
+    if "numberValue" in u:
+        v = u["numberValue"]
+        return str(int(v)) if float(v).is_integer() else str(v)
+    return u.get("stringValue", "")
+
+
+class FakeWorksheet:
+    def __init__(self, api, sheet, title, rows, ws_id):
+        self.api, self.sheet = api, sheet
+        self.title, self.id = title, ws_id
+        self.rows = [[str(v) for v in r] for r in rows]
+
+    def get_all_values(self, *args, **kwargs):
+        self.api.call("get_all_values")
+        with self.sheet.lock:
+            return [list(r) for r in self.rows]
+
+    def append_row(self, row, *args, **kwargs):
+        self.api.call("append_row")
+        with self.sheet.lock:
+            self.sheet.touch()
+            self.rows.append([str(v) for v in row])
+
+    def append_rows(self, rows, *args, **kwargs):
+        self.api.call("append_rows")
+        with self.sheet.lock:
+            self.sheet.touch()
+            self.rows.extend([str(v) for v in r] for r in rows)
+
+    def clear(self):
+        self.api.call("clear")
+        with self.sheet.lock:
+            self.sheet.touch()
+            self.rows = []
+
+    def batch_update(self, data, **kwargs):
+        self.api.call("values_batch_update")
+        with self.sheet.lock:
+            self.sheet.touch()
+            for d in data:
+                r0, c0 = gspread.utils.a1_to_rowcol(d["range"].split("!")[-1].split(":")[0])
+                for i, vals in enumerate(d["values"]):
+                    while len(self.rows) < r0 + i: self.rows.append([])
+                    row = self.rows[r0 + i - 1]
+                    while len(row) < c0 - 1 + len(vals): row.append("")
+                    for j, v in enumerate(vals): row[c0 - 1 + j] = str(v)
+
+
+class FakeSpreadsheet:
+    def __init__(self, api, tabs):
+        self.api = api
+        self.lock = threading.RLock()
+        self.tabs = [FakeWorksheet(api, self, t, rows, i) for i, (t, rows) in enumerate(tabs.items())]
+        self.revision = 0
+
+    def touch(self):
+        self.revision += 1
+
+    def get_lastUpdateTime(self):
+        self.api.call("get_lastUpdateTime")
+        with self.lock:
+            return f"rev-{self.revision}"
+
+    def _find(self, title):
+        for ws in self.tabs:
+            if ws.title == title: return ws
+        raise gspread.WorksheetNotFound(title)
+
+    def worksheet(self, title):
+        self.api.call("worksheet")
+        return self._find(title)
+
+    def get_worksheet(self, index):
+        self.api.call("get_worksheet")
+        return self.tabs[index]
+
+    def worksheets(self, *args, **kwargs):
+        self.api.call("worksheets")
+        return list(self.tabs)
+
+    def add_worksheet(self, title, rows=100, cols=10, **kwargs):
+        self.api.call("add_worksheet")
+        with self.lock:
+            ws = FakeWorksheet(self.api, self, title, [], len(self.tabs))
+            self.tabs.append(ws)
+        return ws
+
+    def values_batch_get(self, ranges, params=None):
+        self.api.call("values_batch_get")
+        out = []
+        with self.lock:
+            for rng in ranges:
+                title, _, a1 = rng.partition("!")
+                rows = self._find(title.strip("'")).rows
+                if a1:
+                    start, _, end = a1.partition(":")
+                    s = int(re.sub(r"\D", "", start) or 1)
+                    e = re.sub(r"\D", "", end or start)
+                    rows = rows[s - 1:int(e) if e else len(rows)]
+                values = []
+                for r in rows:
+                    r = list(r)
+                    while r and r[-1] == "": r.pop()
+                    values.append(r)
+                while values and not values[-1]: values.pop()
+                vr = {"range": rng}
+                if values: vr["values"] = values
+                out.append(vr)
+        return {"valueRanges": out}
+
+    def batch_update(self, body):
+        self.api.call("batch_update")
+        with self.lock:
+            self.touch()
+            for req in body["requests"]:
+                (kind, r), = req.items()
+                sheet_id = r.get("range", {}).get("sheetId", r.get("sheetId"))
+                ws = next(w for w in self.tabs if w.id == sheet_id)
+                if kind == "updateCells":
+                    g = r["range"]
+                    row = ws.rows[g["startRowIndex"]]
+                    while len(row) <= g["startColumnIndex"]: row.append("")
+                    row[g["startColumnIndex"]] = _cell_value(r["rows"][0]["values"][0])
+                elif kind == "deleteDimension":
+                    del ws.rows[r["range"]["startIndex"]:r["range"]["endIndex"]]
+                elif kind == "appendCells":
+                    ws.rows.extend([_cell_value(c) for c in rr["values"]] for rr in r["rows"])
+        return {}
+
+
+class FakeClient:
+    def __init__(self, api, spreadsheet):
+        self.api, self.spreadsheet = api, spreadsheet
+
+    def open_by_url(self, url):
+        self.api.call("open_by_url")
+        return self.spreadsheet
+
+
+class FakeDrive:
+    """googleapiclient 的 service.files().create(...).execute() 介面。"""
+
+    def __init__(self, api):
+        self.api = api
+
+    def files(self):
+        return self
+
+    def create(self, body=None, media_body=None, **kwargs):
+        drive = self
+
+        class Request:
+            def execute(self):
+                drive.api.call("drive_create")
+                if media_body is not None: media_body._fd.read()
+                return {"id": "fake", "webViewLink": "https://drive.example/fake"}
+        return Request()
+
+
+def fake_tabs(headers, people):
+    return {
+        "訂單": [headers],
+        "菜單設定": [["店家", "品項", "中杯", "大杯"], ["五十嵐", "紅茶", "30", "35"], ["五十嵐", "綠茶", "30", "35"],
+                     ["五十嵐", "珍珠奶茶", "45", "55"]],
+        "加料設定": [["店家", "加料品項", "價格"], ["五十嵐", "珍珠", "10"], ["五十嵐", "椰果", "10"]],
+        "會員儲值": [["姓名", "存款餘額"]] + [[p, "1000"] for p in people],
+    }
+
+# ==========================================
+# 2. 載入 app.py (只執行到主程式 UI 之前)
+# ==========================================
+def load_app():
+    """執行 app.py 中第 4 節 (主程式 UI) 之前的所有定義，取得真正的類別與函式。"""
+    import streamlit  # noqa: F401  先載入，才能在執行 app.py 之前調整它的 logger
+    _quiet_streamlit()
+    with open(APP_PATH, encoding="utf-8") as f:
+        src = f.read()
+    cut = src.index("# 4. 主程式邏輯")
+    src = src[:src.rindex("\n# ====", 0, cut)]
+    mod = types.ModuleType("drinks_app")
+    mod.__file__ = APP_PATH
+    exec(compile(src, APP_PATH, "exec"), mod.__dict__)
+    _quiet_streamlit()
+    return mod
+
+
+def _quiet_streamlit():
+    # 沒有 Streamlit runtime 時 st.* 會警告 missing ScriptRunContext，基準測試中可忽略
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"): logging.getLogger(name).setLevel(logging.ERROR)
+
+# ==========================================
+# 3. 量測
+# ==========================================
+def percentile(values, p):
+    if not values: return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, max(0, int(round(p / 100 * (len(s) - 1)))))]
+
+
+class Recorder:
+    def __init__(self, api):
+        self.api = api
+        self.results = {}
+
+    def measure(self, op, fn, count=1, wall=None):
+        """執行 fn 並記錄 API 呼叫差異；fn 回傳每次操作的延遲 (秒) list。fn 拋出例外時記錄錯誤並回傳。"""
+        before = self.api.snapshot()
+        t0 = time.perf_counter()
+        error = None
+        try:
+            latencies = fn()
+        except Exception as e:
+            latencies, error = [time.perf_counter() - t0], f"{type(e).__name__}: {e}"
+        elapsed = wall if wall is not None else time.perf_counter() - t0
+        calls = self.api.snapshot() - before
+        total = sum(calls.values())
+        self.results[op] = {
+            "ops": count,
+            "api_calls": total,
+            "api_calls_per_op": round(total / max(count, 1), 3),
+            "by_method": dict(sorted(calls.items())),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "throughput_ops": round(count / elapsed, 2) if elapsed else 0.0,
+        }
+        if error: self.results[op]["error"] = error
+        return self.results[op]
+
+
+def run(users=20, orders=5, latency=0.03, quota_rate=0.0, seed=0):
+    app = load_app()
+    limiter = app.RateLimiter(BENCH_QUOTA_PER_MIN, BENCH_QUOTA_PER_MIN, BENCH_QUOTA_PER_MIN)
+    def send(name, attempt):
+        bucket = "drive" if name.startswith("drive") else "read" if name in READ_CALLS else "write"
+        return app.send_with_quota(limiter, bucket, attempt,
+                                   is_throttled=lambda e: app.classify_api_error(e) == "quota",
+                                   is_retryable=lambda e: bucket == "read" and app.classify_api_error(e) in ("server", "network"))
+    api = FakeAPI(latency=latency, quota_rate=quota_rate, seed=seed, send=send)
+    people = [f"員工{i:03d}" for i in range(users)]
+    sheet = FakeSpreadsheet(api, fake_tabs(app.ORDER_HEADERS, people))
+    client = FakeClient(api, sheet)
+    workdir = tempfile.mkdtemp(prefix="drinks-bench-")
+    backend = app.SheetsBackend(client, "https://bench.invalid/spreadsheet",
+                                menu_snapshot=app.MenuSnapshot(os.path.join(workdir, "menu_snapshot.json")))
+    rec = Recorder(api)
+    rng = random.Random(seed)
+
+    # --- 冷啟動：設定分頁 + 訂單 ---
+    feed = app.OrderFeed(backend)
+    def cold_load():
+        t0 = time.perf_counter()
+        backend.load_tabs(["menu", "toppings", "balances"])
+        feed.poll(None)
+        return [time.perf_counter() - t0]
+    rec.measure("cold_load", cold_load)
+    menus = app.parse_menu_rows(sheet._find("菜單設定").rows)[0]
+    price_index = app.PriceIndex(menus, app.parse_topping_rows(sheet._find("加料設定").rows))
+
+    # --- 點餐：N 人同時送出，每人 M 杯 (write-behind 佇列) ---
+    queue = app.OrderQueue(backend, spool_path=os.path.join(workdir, "pending.jsonl"))
+    def order_row(name):
+        item, size = rng.choice(["紅茶", "綠茶", "珍珠奶茶"]), rng.choice(["中杯", "大杯"])
+        top = rng.choice(["", "珍珠"])
+        price = price_index.price("五十嵐", item, size, [top] if top else [])
+        return [time.strftime("%Y-%m-%d %H:%M:%S"), "五十嵐", name, item, size, top, price,
+                rng.choice(app.SUGAR_OPTS), rng.choice(app.ICE_OPTS), ""]
+    rows = [order_row(p) for p in people for _ in range(orders)]
+    submit_lat = []
+    lat_lock = threading.Lock()
+    def submit(row):
+        t0 = time.perf_counter()
+        queue.submit(row)
+        with lat_lock: submit_lat.append(time.perf_counter() - t0)
+    def submit_all():
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            list(pool.map(submit, rows))
+        # 等待背景寫入完成，吞吐量以「全部訂單寫進 Sheet」計算
+        deadline = time.time() + 120
+        while queue.pending() and time.time() < deadline:
+            if all(e["status"] == "failed" for e in queue.pending()): queue.flush()
+            time.sleep(0.05)
+        return submit_lat
+    submit_all_result = rec.measure("order_submit", submit_all, count=len(rows))
+    submit_all_result["unflushed"] = len(queue.pending())
+
+    # --- 訂單增量輪詢 ---
+    def poll():
+        lat = []
+        for _ in range(10):
+            t0 = time.perf_counter()
+            feed.poll(feed_state["grid"])
+            lat.append(time.perf_counter() - t0)
+        return lat
+    feed_state = {"grid": backend.get_orders()}
+    rec.measure("order_poll", poll, count=10)
+
+    # --- 管理員儲存：修改一列、刪除一列 (與 app 的編輯表格相同，category 欄先改回一般欄位) ---
+    grid = backend.get_orders()
+    df = app.orders_frame(grid)
+    edited = df.astype({c: object for c in app.ORDER_CATEGORY_COLS if c in df.columns})
+    if len(edited) > 0: edited.loc[edited.index[0], "甜度"] = "無糖"
+    if len(edited) > 1: edited = edited.drop(index=edited.index[1])
+    def admin_save():
+        t0 = time.perf_counter()
+        diff = app.diff_order_rows(grid[0], grid[1:], edited, base_df=df)
+        backend.apply_order_diff(diff, grid[1:])
+        return [time.perf_counter() - t0]
+    rec.measure("admin_save", admin_save)
+
+    # --- 結算：日誌 + 餘額 + 交易紀錄 + 清除訂單 + 背景報表 ---
+    grid = backend.get_orders()
+    df = app.orders_frame(grid)
+    balances = backend.load_balances()
+    font = app.FontProvider(allow_download=False)
+    font.warm()
+    jobs = app.ReportJobs()
+    drive = FakeDrive(api)
+    journal = app.SettlementJournal(os.path.join(workdir, "settlements.json"))
+    archive = app.OrderArchive(os.path.join(workdir, "order_history.db"))
+    state = {}
+    def settle():
+        t0 = time.perf_counter()
+        bal_df = app.build_settlement_frame(df, balances)
+        update_map, logs, expected = app.settlement_changes(bal_df)
+        record = journal.begin(journal.plan(update_map, logs, grid, int(df["價格"].sum()), expected))
+        app.run_settlement(backend, journal, record,
+                           lambda r: jobs.submit(app.orders_frame(r["orders"]), r["total"], "bench.pdf",
+                                                 font, True, drive, "folder"),
+                           archive)
+        state["job"] = record["report_job"]
+        return [time.perf_counter() - t0]
+    rec.measure("settlement", settle)
+    def report():
+        t0 = time.perf_counter()
+        while not (jobs.get(state["job"]) or {}).get("finished"): time.sleep(0.01)
+        return [time.perf_counter() - t0]
+    rec.measure("report_job", report)
+
+    return {
+        "config": {"users": users, "orders_per_user": orders, "latency_s": latency, "quota_rate": quota_rate},
+        "quota_errors": api.quota_errors,
+        "results": rec.results,
+    }
+
+# ==========================================
+# 4. 報表與回歸檢查
+# ==========================================
+def print_report(report):
+    cfg = report["config"]
+    print(f"users={cfg['users']} orders/user={cfg['orders_per_user']} latency={cfg['latency_s']}s "
+          f"quota_rate={cfg['quota_rate']} quota_errors={report['quota_errors']}")
+    print(f"{'operation':<14}{'ops':>6}{'calls':>8}{'calls/op':>10}{'p50 ms':>10}{'p95 ms':>10}{'ops/s':>10}")
+    for op, r in report["results"].items():
+        print(f"{op:<14}{r['ops']:>6}{r['api_calls']:>8}{r['api_calls_per_op']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['throughput_ops']:>10}")
+        print(f"{'':<14}{json.dumps(r['by_method'], ensure_ascii=False)}")
+        if "error" in r: print(f"{'':<14}❌ {r['error']}")
+
+
+def check_regressions(report, baseline, tolerance=BASELINE_TOLERANCE):
+    """回傳超出基準的操作說明 list；基準中沒有的操作不檢查。"""
+    problems = []
+    for op, base in baseline.get("api_calls", {}).items():
+        r = report["results"].get(op)
+        if r is None:
+            problems.append(f"{op}: 這次沒有執行")
+        elif "error" in r:
+            problems.append(f"{op}: {r['error']}")
+        elif r["api_calls"] > max(base * (1 + tolerance), base + 1):  # 背景批次寫入的分批數可能差 1
+            problems.append(f"{op}: API 呼叫 {r['api_calls']} 次，基準 {base} 次")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="飲料點餐系統效能基準測試 (模擬 Google Sheets / Drive)")
+    parser.add_argument("--users", type=int, default=20, help="同時點餐的人數")
+    parser.add_argument("--orders", type=int, default=5, help="每人點餐杯數")
+    parser.add_argument("--latency", type=float, default=0.03, help="每次 API 呼叫的模擬延遲 (秒)")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="每次 API 呼叫回傳 429 的機率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="另外把結果寫成 JSON 檔")
+    parser.add_argument("--check", action="store_true", help="API 呼叫數超過基準時以非 0 結束")
+    parser.add_argument("--write-baseline", action="store_true", help="以這次的 API 呼叫數更新基準")
+    args = parser.parse_args(argv)
+
+    report = run(args.users, args.orders, args.latency, args.quota_rate, args.seed)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.write_baseline:
+        baseline = {"config": report["config"],
+                    "api_calls": {op: r["api_calls"] for op, r in report["results"].items()}}
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"基準已寫入 {BASELINE_PATH}")
+    if args.check:
+        if not os.path.exists(BASELINE_PATH):
+            print("找不到基準檔，請先執行 --write-baseline")
+            return 2
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config", {}).get("users") != args.users or baseline.get("config", {}).get("orders_per_user") != args.orders:
+            print("⚠️ 基準的人數 / 杯數與這次不同，API 呼叫數可能無法直接比較")
+        problems = check_regressions(report, baseline)
+        if problems:
+            print("❌ API 呼叫數回歸：\n  " + "\n  ".join(problems))
+            return 1
+        print("✅ API 呼叫數未超過基準")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())